@@ -0,0 +1,101 @@
+"""
+`offload_latency` measures the round trip latency of small messages while 
+    big ones are decoded and encoded on the same event loop, for each 
+    offload policy
+"""
+import asyncio
+import argparse
+import os
+import socket
+import statistics
+import sys
+import time
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import common.communication as comms
+
+
+async def echo(reader: asyncio.streams.StreamReader, writer: asyncio.streams.StreamWriter) -> None:
+    """
+    Function that sends back every message received
+    """
+    while True:
+        msg: dict | None = await comms.recv_dict(reader)
+        if msg == None: break
+        await comms.send_dict(writer, msg)
+
+
+async def open_pair() -> tuple:
+    """
+    Function to open a connected pair of streams
+    Returns:
+        - Tuple with the (reader, writer) of each side
+    """
+    first, second = socket.socketpair()
+    return await asyncio.open_connection(sock=first), await asyncio.open_connection(sock=second)
+
+
+async def run(bigSize: int, samples: int) -> list[float]:
+    """
+    Function to measure small message latencies while big messages go 
+        back and forth on another connection
+    Args:
+        - bigSize: Size, in bytes, of the big messages
+        - samples: Number of small messages to measure
+    Returns:
+        - list of latencies, in milliseconds
+    """
+    (smallR, smallW), echoSmall = await open_pair()
+    (bigR, bigW), echoBig = await open_pair()
+    echoTasks = [asyncio.create_task(echo(*echoSmall)), asyncio.create_task(echo(*echoBig))]
+
+    bigMsg: dict = {"option": "message", "nick": "big", "message": "x" * bigSize}
+    running: bool = True
+
+    async def big_traffic() -> None:
+        while running:
+            await comms.send_dict(bigW, bigMsg)
+            await comms.recv_dict(bigR)
+
+    bigTask = asyncio.create_task(big_traffic())
+    await asyncio.sleep(0.05)
+
+    latencies: list[float] = []
+    smallMsg: dict = {"option": "message", "nick": "small", "message": "hi"}
+    for _ in range(samples):
+        start: float = time.perf_counter()
+        await comms.sendRecv_dict(smallW, smallR, smallMsg)
+        latencies.append((time.perf_counter() - start) * 1000)
+        await asyncio.sleep(0.001)
+
+    running = False
+    await bigTask
+    for task in echoTasks: task.cancel()
+    for writer in (smallW, bigW, echoSmall[1], echoBig[1]): writer.close()
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", help="Size of the big messages, in bytes", type=int, default=8 * 1024 * 1024)
+    parser.add_argument("--samples", help="Number of small messages measured", type=int, default=300)
+    parser.add_argument("--workers", help="Number of workers in the pool", type=int, default=2)
+    args = parser.parse_args()
+
+    policies: list[tuple] = [
+        ("inline", dict(threshold=2 ** 62, workers=args.workers, processes=False)),
+        ("threads", dict(threshold=comms.offload.threshold, workers=args.workers, processes=False)),
+        ("processes", dict(threshold=comms.offload.threshold, workers=args.workers, processes=True)),
+    ]
+
+    print(f"big messages of {args.size} bytes, {args.samples} small round trips (ms)")
+    print(f"{'policy':<10} {'p50':>8} {'p99':>8} {'max':>8}")
+    for name, policy in policies:
+        comms.configure_offload(**policy)
+        latencies: list[float] = sorted(asyncio.run(run(args.size, args.samples)))
+        p99: float = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{name:<10} {statistics.median(latencies):>8.2f} {p99:>8.2f} {latencies[-1]:>8.2f}")
+    comms.configure_offload()
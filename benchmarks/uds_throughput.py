@@ -0,0 +1,119 @@
+"""
+`uds_throughput` measures how many chat messages per second the server
+    relays from one client to another, when both reach it over TCP loopback
+    and when both reach it over a Unix domain socket
+"""
+import asyncio
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import common.communication as comms
+from server.server import Server
+
+
+def serve(port: int, path: str, ready) -> None:
+    """
+    Function that runs a server listening on TCP and on a Unix domain
+        socket, in its own process so it does not share the clients' loop
+    Args:
+        - port: TCP port to listen on
+        - path: Path of the Unix domain socket
+        - ready: Event set once both listeners are up
+    """
+    # The server warns about every join and disconnect
+    logging.getLogger("Monitor").setLevel(logging.ERROR)
+
+    async def main() -> None:
+        server: Server = Server(10)
+        tcp = await server.create_server('127.0.0.1', port)
+        uds = await server.create_server(comms.UNIX_PREFIX + path, 0)
+        ready.set()
+        await asyncio.gather(tcp.serve_forever(), uds.serve_forever())
+
+    asyncio.run(main())
+
+
+async def join(host: str, port: int, nick: str) -> tuple:
+    """
+    Function to connect a client and send its join message
+    Returns:
+        - Tuple with the (reader, writer) of the client
+    """
+    reader, writer = await comms.SocketTransport().open_connection(host, port)
+    await comms.send_dict(writer, {"option": "join", "nick": nick, "ip": host, "port": port})
+    return reader, writer
+
+
+async def run(host: str, port: int, size: int, count: int) -> float:
+    """
+    Function to measure how long the server takes to relay messages
+        between two clients
+    Args:
+        - host: Address of the server, "unix:<path>" for a Unix domain socket
+        - port: Port of the server
+        - size: Size, in bytes, of each message
+        - count: Number of messages sent
+    Returns:
+        - Seconds from the first message sent to the last one received
+    """
+    receiverR, receiverW = await join(host, port, "receiver")
+    senderR, senderW = await join(host, port, "sender")
+
+    # Wait until the receiver knows the sender, the server registered both
+    while (await comms.recv_dict(receiverR))["option"] != "join": pass
+
+    async def drain_sender() -> None:
+        while await comms.recv_dict(senderR) != None: pass
+
+    drainTask = asyncio.create_task(drain_sender())
+    msg: dict = {"option": "message", "message": "x" * size, "nick": "sender"}
+
+    async def send_all() -> None:
+        for _ in range(count):
+            await comms.send_dict(senderW, msg)
+
+    start: float = time.perf_counter()
+    sendTask = asyncio.create_task(send_all())
+    received: int = 0
+    while received < count:
+        if (await comms.recv_dict(receiverR))["option"] == "message": received += 1
+    elapsed: float = time.perf_counter() - start
+
+    await sendTask
+    for writer in (senderW, receiverW): writer.close()
+    drainTask.cancel()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", help="TCP port of the server", type=int, default=8015)
+    parser.add_argument("--count", help="Number of messages relayed per run", type=int, default=20000)
+    parser.add_argument("--sizes", help="Message sizes, in bytes", type=int, nargs='+', default=[64, 1024, 16 * 1024])
+    parser.add_argument("--repeat", help="Runs per size, the best one is kept", type=int, default=3)
+    args = parser.parse_args()
+
+    path: str = os.path.join(tempfile.mkdtemp(), "bridge.sock")
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=serve, args=(args.port, path, ready), daemon=True)
+    server.start()
+    ready.wait()
+
+    print(f"{args.count} messages relayed from one client to another, best of {args.repeat}")
+    print(f"{'size':>7} {'transport':<9} {'msgs/s':>10} {'MB/s':>8}")
+    for size in args.sizes:
+        for name, host in (("tcp", '127.0.0.1'), ("uds", comms.UNIX_PREFIX + path)):
+            elapsed: float = min(asyncio.run(run(host, args.port, size, args.count)) for _ in range(args.repeat))
+            print(f"{size:>7} {name:<9} {args.count / elapsed:>10.0f} {args.count * size / elapsed / 1e6:>8.1f}")
+
+    server.terminate()
+    os.remove(path)
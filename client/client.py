@@ -4,11 +4,13 @@
 import asyncio
 import argparse
 import os
+import re
 import sys
 import logging
 import aioconsole
 from attr import dataclass
 from datetime import datetime
+from typing import BinaryIO, Callable
 
 # Check https://www.geeksforgeeks.org/python-import-from-parent-directory/
 # For better information
@@ -27,6 +29,8 @@ sys.path.append(parent)
 import common.communication as comms
 import common.utils as util
 
+logger: logging.Logger = logging.getLogger("Monitor")
+
 @dataclass
 class Connection:
     """
@@ -46,17 +50,86 @@ class ClientValues:
     ip: str
     port: int 
 
+BIND_ATTEMPTS: int = 3
+BIND_TIMEOUT: float = 1.0
+
+def safe_file_name(value: object) -> str:
+    """
+    Function to turn a value chosen by a peer into a file name that can't 
+        leave its folder
+    Args:
+        - value: nick or name received
+    Returns:
+        - Base name of the value, with only letters, digits, '.', '_' and '-'
+    """
+    name: str = re.sub(r'[^A-Za-z0-9._-]', '_', os.path.basename(str(value)))
+    return name if name.strip('.') != "" else "_"
+
+
+def download_path(folder: str, msg: dict) -> str | None:
+    """
+    Function to get the path where a received stream is saved
+    Args:
+        - folder: folder of the downloads
+        - msg: stream_start message
+    Returns:
+        - Path inside the folder or None if it would fall outside of it
+    """
+    name: str = f"{safe_file_name(msg['nick'])}_{safe_file_name(msg['name'])}"
+    path: str = os.path.realpath(os.path.join(folder, name))
+    if os.path.dirname(path) != os.path.realpath(folder):
+        logger.warning(f"Refused to save {msg['name']} from {msg['nick']} outside {folder}")
+        return None
+    return path
+
+
+class DatagramChannel(asyncio.DatagramProtocol):
+    """
+    Class used to receive the datagrams sent by the server
+    """
+    def __init__(self, client: "Client") -> None:
+
+        self.client: Client = client
+
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        msg: dict | None = comms.decode_datagram(data)
+        if msg == None:
+            logger.debug(f"Dropped invalid datagram from {addr}")
+        elif msg.get("option") == "bound":
+            self.client.datagramBound.set()
+        else:
+            self.client.process_message(msg)
+
 class Client:
     """
     Class that enables the client
     """
-    def __init__(self, nick: str) -> None:
-
-        self.clients: list[ClientValues] = [] 
+    def __init__(self, nick: str, streamSink: Callable[[dict], BinaryIO | None] | None = None, 
+                transport: comms.Transport | None = None, datagrams: bool = False) -> None:
+        """
+        Args:
+            - nick: Nick of the client
+            - streamSink: function called with each stream_start message, 
+                returning the file-like object where the stream is written 
+                (closed once the stream ends) or None to ignore it
+            - transport: Transport used to reach the server, sockets by default
+            - datagrams: True to bind the datagram channel offered by the 
+                server, used by send_datagram
+        """
+        self.datagrams: bool = datagrams
+        self.datagram: asyncio.DatagramTransport | None = None
+        self.bindTask: asyncio.Task | None = None
+        self.datagramBound: asyncio.Event = asyncio.Event()
+        self.transport: comms.Transport = transport if transport != None else comms.SocketTransport()
+        self.clients: dict[str, ClientValues] = {} # nick -> client
         self.connection: Connection | None = None
         self.nick: str = nick
         self.ip: str = ""
         self.port: int = 0
+        self.streamSink: Callable[[dict], BinaryIO | None] | None = streamSink
+        self.incoming: dict[int, BinaryIO] = {} # stream Id -> sink
+        self.lastStream: int = 1
         
 
     async def connect_client(self, ip: str, port: int) -> tuple:
@@ -64,8 +137,10 @@ class Client:
         Function that uses class values to Connect a client with the 
             designated Ip address and Port
         Args:
-            - ip: Ip address of the Server
-            - port: Port of the Server to operate on
+            - ip: Ip address of the Server, or "unix:<path>" to connect to 
+                a Unix domain socket
+            - port: Port of the Server to operate on, ignored for Unix 
+                domain sockets
         Returns:
             - A tupple object with the asyncio.streams.StreamReader
             and asyncio.streams.StreamWriter
@@ -73,21 +148,21 @@ class Client:
             - ValueError: if Client was already established
             - TypeError: if supplied  attributes are not of correct type  
             - OSError: if connection wasn't established (handled by 
-            asyncio.open_connection function)
+            the transport)
         """
         if self.connection != None: raise ValueError(f"Client already initialized")
 
         if not isinstance(ip, str) or not isinstance(port, int):
             raise TypeError("Wrong usage. Use (str, int) types")
         
-        reader, writer = await asyncio.open_connection(ip, port)
+        reader, writer = await self.transport.open_connection(ip, port)
 
         self.connection = Connection(reader, writer, ip, port)
 
         return (reader, writer)
     
 
-    async def process_message(self, msg: dict) -> None:
+    def process_message(self, msg: dict) -> None:
         """
         Function to process a message received from the server
         Args:
@@ -99,24 +174,49 @@ class Client:
             # {"option": "join", "nick": nick, "ip": ip, "port": port} -> Join message
             if msg["option"] == "join":
                 util.check_dict_fields(msg, ['nick', 'ip', 'port'])
-                if [client for client in self.clients if client.nick == msg['nick']] == []:
-                    self.clients.append(ClientValues(msg["nick"], msg["ip"], msg["port"]))
+                if msg['nick'] not in self.clients:
+                    self.clients[msg['nick']] = ClientValues(msg["nick"], msg["ip"], msg["port"])
                     logger.info(f"Client {msg['nick']} with {msg['ip']}:{msg['port']} has entered")
 
             # {"option": "message", "message": message, "nick": nick} -> Message message
             elif msg["option"] == "message":
                 util.check_dict_fields(msg, ['message', 'nick'])
-                if [client for client in self.clients if client.nick == msg['nick']] != []:
+                if msg['nick'] in self.clients:
                     logger.info(f"Client {msg['nick']}-> {msg['message']}")
                 else:
                     logger.debug(f"Client not registered, message: {msg}")
 
+            # {"option": "stream_start", "nick": nick, "stream": stream, "name": name} -> Stream start message
+            elif msg["option"] == "stream_start":
+                util.check_dict_fields(msg, ['nick', 'stream', 'name'])
+                if msg['nick'] in self.clients:
+                    sink: BinaryIO | None = self.streamSink(msg) if self.streamSink != None else None
+                    if sink != None:
+                        self.incoming[msg['stream']] = sink
+                    logger.info(f"Client {msg['nick']} is sending {msg['name']}")
+                else:
+                    logger.debug(f"Client not registered, message: {msg}")
+
+            # {"option": "stream_end", "nick": nick, "stream": stream} -> Stream end message
+            elif msg["option"] == "stream_end":
+                util.check_dict_fields(msg, ['nick', 'stream'])
+                sink: BinaryIO | None = self.incoming.pop(msg['stream'], None)
+                if sink != None:
+                    sink.close()
+                    logger.info(f"Client {msg['nick']} {'aborted' if msg.get('aborted') else 'finished'} sending")
+
+            # {"option": "datagram", "token": token, "port": port} -> Datagram offer message
+            elif msg["option"] == "datagram":
+                util.check_dict_fields(msg, ['token', 'port'])
+                if self.datagrams and self.bindTask == None and not comms.is_unix_address(self.connection.ip):
+                    self.bindTask = asyncio.get_running_loop().create_task(self.bind_datagram(msg['token'], msg['port']))
+
             # {"option": "disconnect", "nick": nick} -> Disconnect message
             elif msg["option"] == "disconnect":
                 util.check_dict_fields(msg, ['nick'])
-                if [client for client in self.clients if client.nick == msg['nick']] != []:     
-                    self.clients.remove([client for client in self.clients if client == msg["nick"]][0])
-                    logger.info(f"Client {msg['nick']} with {msg['ip']}:{msg['port']} has left")
+                leaving: ClientValues | None = self.clients.pop(msg['nick'], None)
+                if leaving != None:     
+                    logger.info(f"Client {msg['nick']} with {leaving.ip}:{leaving.port} has left")
                 else:
                     logger.debug(f"Client not recognized, message: {msg}")
 
@@ -125,16 +225,117 @@ class Client:
         except ValueError as e:
             logger.debug("Message not in the correct type")
             return
-            
+
+
+    async def bind_datagram(self, token: str, port: int) -> bool:
+        """
+        Function to open the datagram channel with the server and bind it 
+            to this client with the token received when joining
+        Args:
+            - token: token given by the server
+            - port: UDP port of the server
+        Returns:
+            - True if the server acknowledged the binding, false otherwise
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            self.datagram, _ = await loop.create_datagram_endpoint(lambda: DatagramChannel(self), 
+                                                    remote_addr=(self.connection.ip, port))
+        except OSError as e:
+            logger.warning(f"Unable to open the datagram channel: {e}")
+            return False
+
+        # The bind datagram can be lost, so try a few times
+        bindMsg: bytes = comms.encode_datagram({"option": "bind", "token": token})
+        for _ in range(BIND_ATTEMPTS):
+            self.datagram.sendto(bindMsg)
+            try:
+                await asyncio.wait_for(self.datagramBound.wait(), BIND_TIMEOUT)
+                logger.debug(f"Datagrams bound to {self.datagram.get_extra_info('sockname')}")
+                return True
+            except asyncio.TimeoutError:
+                pass
+
+        logger.warning("Server did not acknowledge the datagram channel")
+        return False
+
+
+    async def send_datagram(self, message: str) -> bool:
+        """
+        Function to send an unreliable message, which may be lost but is 
+            never held back by other traffic
+        Args:
+            - message: text of the message
+        Returns:
+            - True if the datagram was sent, false if the channel isn't 
+                bound or the message doesn't fit in a datagram
+        """
+        if not self.datagramBound.is_set():
+            return False
+
+        msg: dict = {"option": "message", "message": message, "nick": self.nick}
+        data: bytes | None = comms.encode_datagram(msg)
+        if data == None:
+            logger.debug(f"Message too big for a datagram: {message}")
+            return False
+
+        self.datagram.sendto(data)
+        return True
+
+
+    async def process_chunk(self, chunk: comms.Chunk) -> None:
+        """
+        Function to write a received chunk into the sink of its stream
+        Args:
+            - chunk: Received chunk
+        """
+        sink: BinaryIO | None = self.incoming.get(chunk.stream)
+        if sink == None:
+            logger.debug(f"Chunk of unknown stream {chunk.stream}")
+            return
+
+        sink.write(chunk.data)
+
+
+    async def send_stream(self, source: BinaryIO, name: str, 
+                        chunkSize: int = comms.CHUNK_SIZE) -> bool:
+        """
+        Function to stream the contents of a file-like object to all the 
+            other clients, one chunk at a time
+        Args:
+            - source: file-like object opened for binary reading
+            - name: name of the payload, shown to the receivers
+            - chunkSize: maximum number of bytes sent in each chunk
+        Returns:
+            - True if the whole payload was sent, false otherwise
+        """
+        stream: int = self.lastStream
+        self.lastStream = comms.next_stream_id(self.lastStream)
+
+        startMsg: dict = {"option": "stream_start", "nick": self.nick, "stream": stream, "name": name}
+        if not await comms.send_dict(self.connection.writer, startMsg):
+            return False
+
+        if not await comms.send_stream(self.connection.writer, stream, source, chunkSize):
+            return False
+
+        endMsg: dict = {"option": "stream_end", "nick": self.nick, "stream": stream}
+        return await comms.send_dict(self.connection.writer, endMsg)
+
 
     async def receive_client(self) -> None:
         """
         Main Function used to just handle the reception of data from the    
             server
         """
-        ipRaw: tuple= self.connection.writer.get_extra_info('peername')
-        self.ip: str = ipRaw[0]
-        self.port: int = ipRaw[1]
+        ipRaw: tuple | str = self.connection.writer.get_extra_info('peername')
+        # Unix domain sockets have a path, not an (ip, port) pair
+        if isinstance(ipRaw, tuple):
+            self.ip: str = ipRaw[0]
+            self.port: int = ipRaw[1]
+        else:
+            self.ip: str = self.connection.ip
+            self.port: int = 0
         joinMsg: dict =  {
                         "option": "join", 
                         "nick": self.nick, 
@@ -144,13 +345,28 @@ class Client:
         await comms.send_dict(self.connection.writer, joinMsg)
 
         while True:
-            msg: dict = await comms.recv_dict(self.connection.reader)
+            msg: dict | comms.Chunk = await comms.recv_frame(self.connection.reader)
             
             if msg == None: break
 
+            if isinstance(msg, comms.Chunk):
+                await self.process_chunk(msg)
+                continue
+
             logger.debug("Received: " + str(msg))
 
-            await self.process_message(msg)
+            self.process_message(msg)
+
+        # Streams still open will never get their stream_end
+        for sink in self.incoming.values():
+            sink.close()
+        self.incoming.clear()
+
+        # Datagrams are only relayed while joined over the connection
+        if self.bindTask != None and not self.bindTask.done():
+            self.bindTask.cancel()
+        if self.datagram != None:
+            self.datagram.close()
 
 
             #print('Close the connection')
@@ -164,6 +380,23 @@ class Client:
         while True:
             await asyncio.sleep(0.5)
             input_str: str = await aioconsole.ainput("MSG-> ")
+
+            # "/udp <message>" -> send an unreliable message to everyone
+            if input_str.startswith("/udp "):
+                if not await self.send_datagram(input_str[len("/udp "):]):
+                    logger.error("Unable to send datagram")
+                continue
+
+            # "/send <path>" -> stream a file to everyone
+            if input_str.startswith("/send "):
+                path: str = input_str[len("/send "):].strip()
+                try:
+                    with open(path, 'rb') as source:
+                        await self.send_stream(source, os.path.basename(path))
+                except OSError as e:
+                    logger.error(f"Unable to send {path}: {e}")
+                continue
+
             msg: dict = {
                         "option": "message", 
                         "message": input_str, 
@@ -176,7 +409,7 @@ class Client:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--bind", help="IP address to bind to", default="127.0.0.1")
+    parser.add_argument("--bind", help="IP address to bind to, or unix:<path> for a Unix domain socket", default="127.0.0.1")
     parser.add_argument("--port", help="TCP port", type=int, default=8005)
     parser.add_argument("--maxClients", help="Maximum number of clients", 
                             type=int, default=5)
@@ -184,15 +417,29 @@ if __name__ == "__main__":
                             type=str, default='INFO')
     parser.add_argument("--nick", help="Nick for the player (Max 20 characters)", 
                     type=str, required=True)
+    parser.add_argument("--downloads", help="Folder where received files are saved", 
+                    type=str, default='./downloads')
+    parser.add_argument("--udp", help="Bind the datagram channel, if the server offers it", 
+                    action='store_true')
+    parser.add_argument("--offloadThreshold", help="Messages bigger than this (bytes) are encoded/decoded in a worker pool", 
+                    type=int, default=comms.offload.threshold)
+    parser.add_argument("--offloadWorkers", help="Number of workers in the pool", 
+                    type=int, default=comms.offload.workers)
+    parser.add_argument("--offloadThreads", help="Use a thread pool instead of a process pool (only helps if encoding releases the GIL)", 
+                    action='store_true')
+    parser.add_argument("--controlBurst", help="Most join/disconnect messages sent in a row while chat messages wait", 
+                    type=int, default=comms.scheduling.controlBurst)
     args = parser.parse_args()
 
+    comms.configure_offload(args.offloadThreshold, args.offloadWorkers, not args.offloadThreads)
+    comms.configure_scheduling(args.controlBurst)
+
     # check Logger value
     numericLogLeved = getattr(logging, args.log.upper(), None)
     if not isinstance(numericLogLeved, int):
         raise ValueError('Invalid log level: %s' % numericLogLeved)
 
-    # Creating an object
-    logger: logging.Logger= logging.getLogger("Monitor")
+    # Configure the module logger
     logger.setLevel(logging.DEBUG)
 
 
@@ -216,14 +463,27 @@ if __name__ == "__main__":
     # add fh to logger
     logger.addHandler(fh)
 
-    async def main(ip: str, port: int, nick: str) -> None:
+    def save_stream(msg: dict) -> BinaryIO | None:
+        """
+        Function to open the file where a received stream is saved
+        Args:
+            - msg: stream_start message
+        Returns:
+            - File opened for binary writing or None to ignore the stream
+        """
+        if not os.path.exists(args.downloads):
+            os.mkdir(args.downloads)
+        path: str | None = download_path(args.downloads, msg)
+        return open(path, 'wb') if path != None else None
+
+    async def main(ip: str, port: int, nick: str, udp: bool) -> None:
 
         # Check and resize caller nick (max characters of 20)
         if len(nick) > 20:
             nick = nick[:20]
 
         # Create the caller class
-        client: Client = Client(nick)
+        client: Client = Client(nick, save_stream, datagrams=udp)
 
         # Connect the caller to the playing_area (server)
         await client.connect_client(ip, port)
@@ -243,7 +503,7 @@ if __name__ == "__main__":
             except RuntimeError:
                 loop = asyncio.new_event_loop()
 
-        loop.run_until_complete(main(args.bind, args.port, args.nick))
+        loop.run_until_complete(main(args.bind, args.port, args.nick, args.udp))
         loop.close()
     except KeyboardInterrupt:
         logger.error("\Client Terminated")
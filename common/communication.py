@@ -4,6 +4,326 @@
 import json
 import asyncio
 import base64
+import multiprocessing
+import random
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import BinaryIO
+from attr import dataclass
+
+
+CHUNK_FLAG: int = 0x80000000
+"""Bit set in the frame header when the frame carries a raw stream chunk"""
+STREAM_ID_SIZE: int = 4
+"""Size, in bytes, of the stream identifier that precedes the chunk data"""
+STREAM_ID_LIMIT: int = 2 ** (8 * STREAM_ID_SIZE)
+"""Stream identifiers are integers below this value"""
+CHUNK_SIZE: int = 64 * 1024
+"""Default amount of payload bytes sent in each chunk"""
+MAX_CHUNK_SIZE: int = 1024 * 1024
+"""Biggest chunk payload accepted from a stream"""
+CONTROL: int = 0
+"""Priority of membership and other control frames, sent before data"""
+DATA: int = 1
+"""Priority of chat messages and streamed payloads"""
+CONTROL_OPTIONS: set[str] = {"join", "disconnect"}
+"""Message options that are sent with CONTROL priority"""
+MAX_DATAGRAM_SIZE: int = 1200
+"""Biggest datagram sent or accepted, small enough to avoid IP fragmentation"""
+UNIX_PREFIX: str = "unix:"
+"""Prefix of addresses that are paths of Unix domain sockets"""
+
+
+@dataclass
+class Chunk:
+    """
+    Class used to represent a piece of a streamed payload. The data is a 
+        view over the received frame, so it can be forwarded or written 
+        without being copied
+    """
+    stream: int
+    data: memoryview | bytes
+
+
+@dataclass
+class OffloadPolicy:
+    """
+    Class used to store when and where dictionaries are encoded and 
+        decoded. Frames up to threshold bytes are handled inline, bigger 
+        ones in a pool of workers, so they don't freeze the event loop. 
+        Processes are used by default, since json and base64 hold the GIL 
+        for a whole frame and a thread pool barely helps
+    """
+    threshold: int = 256 * 1024
+    workers: int = 2
+    processes: bool = True
+    executor: Executor | None = None
+
+
+offload: OffloadPolicy = OffloadPolicy()
+"""Offload policy in use, change it with configure_offload"""
+sendLocks: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+"""Locks that keep the frames of each StreamWriter in the order they were sent"""
+
+
+@dataclass
+class SchedulingPolicy:
+    """
+    Class used to store how frames of different priorities are sent. 
+        controlBurst is the starvation guard: the most CONTROL frames sent 
+        in a row while DATA frames are waiting
+    """
+    controlBurst: int = 16
+
+
+scheduling: SchedulingPolicy = SchedulingPolicy()
+"""Scheduling policy in use, change it with configure_scheduling"""
+outboxes: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+"""Outbox of each StreamWriter"""
+
+
+def configure_scheduling(controlBurst: int) -> None:
+    """
+    Function to change the scheduling policy
+    Args:
+        - controlBurst: most CONTROL frames sent in a row while DATA frames 
+            are waiting
+    Raises:
+        - ValueError: if controlBurst is not positive
+    """
+    if controlBurst < 1:
+        raise ValueError("controlBurst must be at least 1")
+    scheduling.controlBurst = controlBurst
+
+
+def priority_of(jsonDict: dict) -> int:
+    """
+    Function to get the priority a message is sent with
+    Args:
+        - jsonDict: JSON dictionary to send
+    Returns:
+        - CONTROL for options in CONTROL_OPTIONS, DATA otherwise
+    """
+    return CONTROL if jsonDict.get("option") in CONTROL_OPTIONS else DATA
+
+
+def can_write_now(writer: asyncio.streams.StreamWriter) -> bool:
+    """
+    Function to check if a writer takes more data without having to drain
+    Args:
+        - writer: StreamWriter of the connection
+    Returns:
+        - True if its transport is open and below its high-water mark
+    """
+    transport: asyncio.WriteTransport = writer.transport
+    return not transport.is_closing() \
+        and transport.get_write_buffer_size() <= transport.get_write_buffer_limits()[1]
+
+
+class Outbox:
+    """
+    Class used to queue the frames sent to a StreamWriter. Frames are 
+        written one at a time, each after the previous one was drained, so 
+        the backlog stays in the queues where CONTROL frames can jump ahead 
+        of DATA frames. Frames of the same priority keep their order. The 
+        outbox doesn't keep its writer, which is only referenced while 
+        frames are being flushed, so outboxes are collected with their writers
+    """
+    def __init__(self) -> None:
+
+        self.queues: tuple[deque, deque] = (deque(), deque()) # indexed by priority
+        self.controlStreak: int = 0
+        self.task: asyncio.Task | None = None
+
+
+    def put(self, writer: asyncio.streams.StreamWriter, buffers: list[bytes], 
+            priority: int) -> asyncio.Future:
+        """
+        Function to queue a frame
+        Args:
+            - writer: StreamWriter the frame is written to
+            - buffers: pieces of the frame, written back to back
+            - priority: CONTROL or DATA
+        Returns:
+            - Future set to True once the frame was sent, False if it failed
+        """
+        future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        # Without a backlog there is nothing to jump ahead of, so the frame 
+        # is written at once, as long as the writer would not block
+        if self.task == None and not self.queues[CONTROL] and not self.queues[DATA] \
+                and can_write_now(writer):
+            writer.writelines(buffers)
+            future.set_result(True)
+            return future
+
+        self.queues[priority].append((buffers, future))
+
+        # The flushing task only lives while there are frames to send
+        if self.task == None:
+            self.task = asyncio.create_task(self.flush(writer))
+        return future
+
+
+    def next_frame(self) -> tuple:
+        """
+        Function to take the next frame to send out of the queues
+        Returns:
+            - Tuple with the buffers and the future of the frame
+        """
+        control, data = self.queues
+        if not data:
+            self.controlStreak = 0
+            return control.popleft()
+
+        if control and self.controlStreak < scheduling.controlBurst:
+            self.controlStreak += 1
+            return control.popleft()
+
+        self.controlStreak = 0
+        return data.popleft()
+
+
+    async def flush(self, writer: asyncio.streams.StreamWriter) -> None:
+        """
+        Function to send every queued frame
+        Args:
+            - writer: StreamWriter the frames are written to
+        """
+        try:
+            while self.queues[CONTROL] or self.queues[DATA]:
+                buffers, future = self.next_frame()
+                try:
+                    writer.writelines(buffers)
+                    await writer.drain()
+                except OSError as e:
+                    # The connection is gone, so nothing else can be sent
+                    for queue in self.queues:
+                        for _, pending in queue:
+                            if not pending.done(): pending.set_result(False)
+                        queue.clear()
+                    if not future.done(): future.set_result(False)
+                    return
+
+                # The sender may have been cancelled while waiting
+                if not future.done(): future.set_result(True)
+        finally:
+            self.task = None
+
+
+def get_outbox(writer: asyncio.streams.StreamWriter) -> Outbox:
+    """
+    Function to get the outbox of a writer, creating it if needed
+    Args:
+        - writer: StreamWriter of the connection
+    Returns:
+        - Outbox of the writer
+    """
+    outbox: Outbox | None = outboxes.get(writer)
+    if outbox == None:
+        outbox = Outbox()
+        outboxes[writer] = outbox
+    return outbox
+
+
+def configure_offload(threshold: int | None = None, workers: int | None = None, 
+                    processes: bool | None = None) -> None:
+    """
+    Function to change the offload policy. Arguments left as None keep 
+        their current value
+    Args:
+        - threshold: Size, in bytes, above which frames are offloaded
+        - workers: Number of workers in the pool
+        - processes: True to use a process pool, False for a thread pool
+    Raises:
+        - ValueError: if threshold is negative or workers is not positive
+    """
+    if threshold != None and threshold < 0:
+        raise ValueError("threshold cannot be negative")
+    if workers != None and workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    # The pool is recreated, with the new values, on its next use
+    if offload.executor != None:
+        offload.executor.shutdown(wait=False)
+        offload.executor = None
+
+    if threshold != None: offload.threshold = threshold
+    if workers != None: offload.workers = workers
+    if processes != None: offload.processes = processes
+
+
+def get_executor() -> Executor:
+    """
+    Function to get the worker pool of the offload policy, creating it if 
+        needed
+    Returns:
+        - Thread or Process pool executor
+    """
+    if offload.executor == None:
+        if offload.processes:
+            # Forked workers would inherit every socket open at this point, 
+            # and closing those connections would no longer reach the peer
+            offload.executor = ProcessPoolExecutor(max_workers=offload.workers, 
+                                                mp_context=multiprocessing.get_context("forkserver"))
+        else:
+            offload.executor = ThreadPoolExecutor(max_workers=offload.workers, 
+                                                thread_name_prefix="comms")
+    return offload.executor
+
+
+def send_lock(writer: asyncio.streams.StreamWriter) -> asyncio.Lock:
+    """
+    Function to get the lock that serializes the frames sent to a writer
+    Args:
+        - writer: StreamWriter of the connection
+    Returns:
+        - Lock of the writer
+    """
+    lock: asyncio.Lock | None = sendLocks.get(writer)
+    if lock == None:
+        lock = asyncio.Lock()
+        sendLocks[writer] = lock
+    return lock
+
+
+def send_lock_held(writer: asyncio.streams.StreamWriter) -> bool:
+    """
+    Function to check if a frame for a writer is still in the worker pool, 
+        so the frames that follow it have to wait for the lock
+    Args:
+        - writer: StreamWriter of the connection
+    Returns:
+        - True if the lock of the writer is held, false otherwise
+    """
+    lock: asyncio.Lock | None = sendLocks.get(writer)
+    return lock != None and lock.locked()
+
+
+def estimate_size(obj: object) -> int:
+    """
+    Function to estimate, without encoding it, how many bytes an object 
+        takes once converted to JSON
+    Args:
+        - obj: JSON compatible object
+    Returns:
+        - Approximate size in bytes
+    """
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    if isinstance(obj, dict):
+        # Messages are mostly flat dicts of strings, sized here without a 
+        # call per value since this runs for every frame sent
+        size: int = 0
+        for key, value in obj.items():
+            size += len(key) if isinstance(key, str) else 8
+            size += len(value) if isinstance(value, str) else estimate_size(value)
+        return size
+    if isinstance(obj, (list, tuple)):
+        return sum(estimate_size(value) for value in obj)
+    return 8
 
 
 def json_to_bytes(jsonDict: dict) -> bytes:
@@ -30,7 +350,71 @@ def bytes_to_json(dictByte: bytes) -> dict:
     decodeB64 = base64.b64decode(dictByte)
     strData = decodeB64.decode() # default decoding is utf-8
     return json.loads(strData)
-    
+
+
+async def encode_dict(jsonDict: dict) -> bytes:
+    """
+    Function to convert a JSON dictionary to bytes, in the worker pool if 
+        it is bigger than the offload threshold
+    Args:
+        - jsonDict: JSON dict object to transform
+    Returns:
+        - converted dictionary to bytes
+    """
+    if estimate_size(jsonDict) <= offload.threshold:
+        return json_to_bytes(jsonDict)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), json_to_bytes, jsonDict)
+
+
+async def decode_dict(dictByte: bytes) -> dict:
+    """
+    Function to convert bytes into a JSON dictionary, in the worker pool if 
+        they are bigger than the offload threshold
+    Args:
+        - dictByte: JSON Dictionary in bytes object
+    Returns:
+        - Bytes object converted to dictionary
+    """
+    if len(dictByte) <= offload.threshold:
+        return bytes_to_json(dictByte)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), bytes_to_json, dictByte)
+
+
+def encode_datagram(jsonDict: dict) -> bytes | None:
+    """
+    Function to convert a JSON dictionary into a datagram. Datagrams carry 
+        a single message, so they have no length header
+    Args:
+        - jsonDict: JSON dict object to transform
+    Returns:
+        - Datagram bytes or None if it would be bigger than MAX_DATAGRAM_SIZE
+    """
+    byteData: bytes = json_to_bytes(jsonDict)
+    if len(byteData) > MAX_DATAGRAM_SIZE: return None
+    return byteData
+
+
+def decode_datagram(data: bytes) -> dict | None:
+    """
+    Function to convert a datagram into a JSON dictionary
+    Args:
+        - data: Datagram bytes
+    Returns:
+        - Dictionary or None if the datagram is oversize or malformed
+    """
+    if len(data) > MAX_DATAGRAM_SIZE: return None
+
+    try:
+        msg = bytes_to_json(data)
+    except ValueError as e:
+        return None
+
+    return msg if isinstance(msg, dict) else None
+
 
 async def exact_recv(reader: asyncio.streams.StreamReader, nBytes: int) -> bytes | None:
     """ 
@@ -48,7 +432,7 @@ async def exact_recv(reader: asyncio.streams.StreamReader, nBytes: int) -> bytes
             if len(msg) == 0: return None
 
             byteData += msg
-            nBytes -= len(byteData) # make sure that the data is read
+            nBytes -= len(msg) # make sure that the data is read
         return byteData
     except OSError as e:
         # Maybe add log here
@@ -87,19 +471,15 @@ async def recv_dict(reader: asyncio.streams.StreamReader) -> dict | None:
     Raises:
         SyntaxError if the signature provided is invalid
     """
-    header = await exact_recv(reader, 4)
-
-    if header == None: return None
-
-    msgLength = int.from_bytes(header, 'big')
-    message: bytes | None = await exact_recv(reader, msgLength)
+    while True:
+        frame: dict | Chunk | None = await recv_frame(reader)
 
-    if message == None: return None
-
-    return bytes_to_json(message)
+        # Chunks are only understood by recv_frame callers, so skip them
+        if not isinstance(frame, Chunk): return frame
     
 
-async def send_dict(writer: asyncio.streams.StreamWriter, jsonDict: dict) -> bool:
+async def send_dict(writer: asyncio.streams.StreamWriter, jsonDict: dict, 
+                    priority: int | None = None) -> bool:
     """
     Function to send a dictionary message to a stream. Transmits 1
     header with the length (in bytes) of a JSON dict object and then 
@@ -108,6 +488,7 @@ async def send_dict(writer: asyncio.streams.StreamWriter, jsonDict: dict) -> boo
     Args:
         writer: StreamWriter object that contains the stream to write on
         jsonDict: JSON dictionary to send
+        priority: CONTROL or DATA, if None it is given by priority_of
         privkey: Private key used to sign the message, if not provided (None) the message isn't signed.
         cheat_signature: When True, the signature will be wrong.
         
@@ -124,11 +505,207 @@ async def send_dict(writer: asyncio.streams.StreamWriter, jsonDict: dict) -> boo
         raise TypeError(f"Invalid jsonDict parameter, expected 'dict', received {type(jsonDict)}")
 
 
-    byteData: bytes = json_to_bytes(jsonDict)
+    if priority == None:
+        priority = priority_of(jsonDict)
+
+    # Small frames are encoded and queued right away, unless a big one 
+    # is still in the worker pool and they would overtake it
+    if estimate_size(jsonDict) <= offload.threshold and not send_lock_held(writer):
+        byteData: bytes = json_to_bytes(jsonDict)
+        return await get_outbox(writer).put(writer, [len(byteData).to_bytes(4, 'big'), byteData], priority)
+
+    # Holding the lock while encoding keeps small frames from overtaking 
+    # big ones that are still in the worker pool
+    async with send_lock(writer):
+        byteData: bytes = await encode_dict(jsonDict)
+
+        sent: asyncio.Future = get_outbox(writer).put(writer, [len(byteData).to_bytes(4, 'big'), byteData], priority)
+        
+    return await sent
+
+
+async def send_encoded(writer: asyncio.streams.StreamWriter, byteData: bytes, 
+                    priority: int = DATA) -> bool:
+    """
+    Function to send a dictionary already converted by encode_dict, so the 
+        same message can be sent to several streams while encoded only once
+    Args:
+        - writer: StreamWriter object that contains the stream to write on
+        - byteData: Encoded JSON dictionary
+        - priority: CONTROL or DATA
+    Returns:
+        True or False given the status of the operation
+    """
+    frame: list[bytes] = [len(byteData).to_bytes(4, 'big'), byteData]
+    if not send_lock_held(writer):
+        return await get_outbox(writer).put(writer, frame, priority)
+
+    async with send_lock(writer):
+        sent: asyncio.Future = get_outbox(writer).put(writer, frame, priority)
+        
+    return await sent
+
+
+async def broadcast_encoded(writers: list[asyncio.streams.StreamWriter], byteData: bytes, 
+                    priority: int = DATA) -> list[bool]:
+    """
+    Function to send a dictionary already converted by encode_dict to 
+        several streams. It is queued on every stream before waiting for 
+        any of them, so receivers are served side by side
+    Args:
+        - writers: list of StreamWriters to send the message to
+        - byteData: Encoded JSON dictionary
+        - priority: CONTROL or DATA
+    Returns:
+        list with the status of each writer
+    """
+    header: bytes = len(byteData).to_bytes(4, 'big')
+    sent: list[asyncio.Future] = []
+    for writer in writers:
+        if not send_lock_held(writer):
+            sent.append(get_outbox(writer).put(writer, [header, byteData], priority))
+            continue
+        async with send_lock(writer):
+            sent.append(get_outbox(writer).put(writer, [header, byteData], priority))
+
+    # Frames written at once are done already, gathering them would cost 
+    # a pass of the event loop
+    if all(future.done() for future in sent):
+        return [future.result() for future in sent]
+    return await asyncio.gather(*sent)
+
+
+def is_stream_id(stream: object) -> bool:
+    """
+    Function to check if a value received in a message is a valid stream 
+        identifier
+    Args:
+        - stream: value to check
+    Returns:
+        - True if it is an integer that fits in a chunk header, false otherwise
+    """
+    return isinstance(stream, int) and 0 <= stream < STREAM_ID_LIMIT
+
+
+def next_stream_id(stream: int) -> int:
+    """
+    Function to get the stream identifier that follows another, wrapping 
+        around so it always fits in a chunk header. 0 is never used
+    Args:
+        - stream: previous stream identifier
+    Returns:
+        - next stream identifier
+    """
+    return stream % (STREAM_ID_LIMIT - 1) + 1
+
+
+def chunk_header(stream: int, nBytes: int) -> bytes:
+    """
+    Function to build the header of a chunk frame
+    Args:
+        - stream: Identification number of the stream
+        - nBytes: Number of payload bytes carried by the chunk
+    Returns:
+        - Frame header, with the chunk flag set, followed by the stream Id
+    """
+    frameLength: int = (STREAM_ID_SIZE + nBytes) | CHUNK_FLAG
+    return frameLength.to_bytes(4, 'big') + stream.to_bytes(STREAM_ID_SIZE, 'big')
+
+
+async def recv_frame(reader: asyncio.streams.StreamReader) -> dict | Chunk | None:
+    """
+    Function to receive a frame from a stream, which can either be a 
+        dictionary message or a raw chunk of a streamed payload. Chunks 
+        are returned as they arrive, without decoding or reassembly
+    Args:
+        - reader: StreamReader wich contains the stream to read from
+    Returns:
+        - Dictionary or Chunk received or None if anything wrong happened
+    """
+    header = await exact_recv(reader, 4)
+
+    if header == None: return None
+
+    msgLength = int.from_bytes(header, 'big')
+
+    if msgLength & CHUNK_FLAG:
+        msgLength &= ~CHUNK_FLAG
+        if msgLength < STREAM_ID_SIZE or msgLength > STREAM_ID_SIZE + MAX_CHUNK_SIZE:
+            return None
+
+        body: bytes | None = await exact_recv(reader, msgLength)
+        if body == None: return None
+
+        stream: int = int.from_bytes(body[:STREAM_ID_SIZE], 'big')
+        return Chunk(stream, memoryview(body)[STREAM_ID_SIZE:])
+
+    message: bytes | None = await exact_recv(reader, msgLength)
+
+    if message == None: return None
+
+    # Frames of a reader are awaited one at a time, so their order is kept
+    return await decode_dict(message)
+
+
+async def send_chunk(writer: asyncio.streams.StreamWriter, stream: int, data: bytes) -> bool:
+    """
+    Function to send a chunk of a streamed payload. The data is sent raw, 
+        without being encoded
+    Args:
+        - writer: StreamWriter wich contains the stream to write on
+        - stream: Identification number of the stream
+        - data: payload bytes of the chunk
+    Returns:
+        - True if the data was sent, false otherwise
+    Raises:
+        - ValueError: if data is bigger than MAX_CHUNK_SIZE
+    """
+    if len(data) > MAX_CHUNK_SIZE:
+        raise ValueError(f"Chunk too big, maximum is {MAX_CHUNK_SIZE} bytes")
+
+    # Chunks are DATA, so they stay behind the stream_start that announced them
+    return await get_outbox(writer).put(writer, [chunk_header(stream, len(data)), data], DATA)
+
+
+async def relay_chunk(writers: list[asyncio.streams.StreamWriter], stream: int, 
+                    data: memoryview | bytes) -> None:
+    """
+    Function to forward a chunk to several streams at once. It only 
+        returns when every writer sent the chunk, so the caller is held 
+        back by the slowest receiver
+    Args:
+        - writers: list of StreamWriters to forward the chunk to
+        - stream: Identification number of the stream, as seen by receivers
+        - data: payload bytes of the chunk
+    """
+    header: bytes = chunk_header(stream, len(data))
+
+    # Failing writers are dropped by their own handlers
+    sent: list[asyncio.Future] = [get_outbox(writer).put(writer, [header, data], DATA) for writer in writers]
+    if not all(future.done() for future in sent):
+        await asyncio.gather(*sent)
+
+
+async def send_stream(writer: asyncio.streams.StreamWriter, stream: int, 
+                    source: BinaryIO, chunkSize: int = CHUNK_SIZE) -> bool:
+    """
+    Function to send the contents of a file-like object as a sequence of 
+        chunks, without loading it whole into memory
+    Args:
+        - writer: StreamWriter wich contains the stream to write on
+        - stream: Identification number of the stream
+        - source: file-like object opened for binary reading
+        - chunkSize: maximum number of bytes sent in each chunk
+    Returns:
+        - True if the data was sent, false otherwise
+    """
+    while True:
+        data: bytes = source.read(chunkSize)
+        if not data: return True
+
+        if not await send_chunk(writer, stream, data):
+            return False
 
-    headerAndData: bytes = len(byteData).to_bytes(4, 'big') + byteData
-    
-    return await exact_send(writer, headerAndData)
 
 async def sendRecv_dict(writer: asyncio.streams.StreamWriter, 
                     reader: asyncio.streams.StreamReader, 
@@ -149,3 +726,394 @@ async def sendRecv_dict(writer: asyncio.streams.StreamWriter,
 
     
 
+
+def is_unix_address(host: str) -> bool:
+    """
+    Function to check if an address is the path of a Unix domain socket
+    Args:
+        - host: Address given by the user
+    Returns:
+        - True if it starts with UNIX_PREFIX, false otherwise
+    """
+    return host.startswith(UNIX_PREFIX)
+
+
+class Transport(ABC):
+    """
+    Class that defines how connections are opened and accepted, so the 
+        client and server can run over sockets or over an in-memory network
+    """
+    @abstractmethod
+    async def open_connection(self, host: str, port: int) -> tuple:
+        """
+        Function to connect to a server
+        Args:
+            - host: Address of the server
+            - port: Port of the server
+        Returns:
+            - A tupple object with the asyncio.streams.StreamReader
+            and asyncio.streams.StreamWriter
+        Raises:
+            - OSError: if connection wasn't established
+        """
+
+
+    @abstractmethod
+    async def start_server(self, callback, host: str, port: int):
+        """
+        Function to start accepting connections
+        Args:
+            - callback: coroutine function called with the 
+                (StreamReader, StreamWriter) of every new connection
+            - host: Address to bind to
+            - port: Port to bind to
+        Returns:
+            - Server object, with close, wait_closed and serve_forever
+        Raises:
+            - OSError: if the server couldn't be started
+        """
+
+
+class SocketTransport(Transport):
+    """
+    Class that opens and accepts real connections. Addresses starting with 
+        UNIX_PREFIX use the Unix domain socket at that path, and their port 
+        is ignored, any other address uses TCP
+    """
+    async def open_connection(self, host: str, port: int) -> tuple:
+        if is_unix_address(host):
+            return await asyncio.open_unix_connection(host[len(UNIX_PREFIX):])
+        return await asyncio.open_connection(host, port)
+
+
+    async def start_server(self, callback, host: str, port: int) -> asyncio.base_events.Server:
+        if is_unix_address(host):
+            return await asyncio.start_unix_server(callback, host[len(UNIX_PREFIX):])
+        return await asyncio.start_server(callback, host, port)
+
+
+class MemoryConnection(asyncio.Transport):
+    """
+    Class used to represent one side of an in-memory connection. Data 
+        written on it reaches the peer through the MemoryTransport, which 
+        applies delays, bandwidth limits and drops
+    """
+    def __init__(self, network: "MemoryTransport", protocol: asyncio.Protocol, 
+                sockname: tuple, peername: tuple) -> None:
+        super().__init__({'sockname': sockname, 'peername': peername})
+
+        self.network: MemoryTransport = network
+        self.protocol: asyncio.Protocol = protocol
+        self.peer: MemoryConnection | None = None
+        self.pending: deque = deque() # (arrival time, bytes or None for EOF) on the way to the peer
+        self.buffered: int = 0
+        self.highWater: int = 64 * 1024
+        self.lowWater: int = 16 * 1024
+        self.writingPaused: bool = False
+        self.readingPaused: bool = False
+        self.stalledAt: float | None = None # when delivery stopped for the peer to resume reading
+        self.closing: bool = False
+        self.lost: bool = False
+
+
+    def write(self, data: bytes) -> None:
+        if self.closing or not data: return
+        self.network.send(self, bytes(data))
+
+
+    def can_write_eof(self) -> bool:
+        return False
+
+
+    def get_write_buffer_size(self) -> int:
+        return self.buffered
+
+
+    def get_write_buffer_limits(self) -> tuple:
+        return (self.lowWater, self.highWater)
+
+
+    def set_write_buffer_limits(self, high: int | None = None, low: int | None = None) -> None:
+        self.highWater = 64 * 1024 if high == None else high
+        self.lowWater = self.highWater // 4 if low == None else low
+
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+
+    def is_reading(self) -> bool:
+        return not self.readingPaused and not self.lost
+
+
+    def pause_reading(self) -> None:
+        self.readingPaused = True
+
+
+    def resume_reading(self) -> None:
+        self.readingPaused = False
+        if self.peer.stalledAt != None:
+            asyncio.get_running_loop().call_soon(self.network.unstall, self.peer)
+
+
+    def receive(self, data: bytes | None) -> None:
+        """
+        Function used by the network to hand data, or EOF when None, to 
+            this side of the connection
+        Args:
+            - data: bytes received or None for EOF
+        """
+        if self.lost: return
+        if data == None:
+            self.protocol.eof_received()
+        else:
+            self.protocol.data_received(data)
+
+
+    def close(self) -> None:
+        if self.closing: return
+        self.closing = True
+        self.network.close(self)
+
+
+    def abort(self) -> None:
+        self.closing = True
+        self.network.reset(self)
+
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        """
+        Function to tell the protocol, only once, that the connection ended
+        Args:
+            - exc: None for a clean close, the error otherwise
+        """
+        if self.lost: return
+        self.lost = True
+        self.closing = True
+        self.network.inFlight -= len(self.pending)
+        self.pending.clear()
+        # Data held for this side is dropped on delivery now
+        if self.peer.stalledAt != None:
+            asyncio.get_running_loop().call_soon(self.network.unstall, self.peer)
+        self.protocol.connection_lost(exc)
+
+
+class MemoryServer:
+    """
+    Class used to represent a server listening on a MemoryTransport
+    """
+    def __init__(self, network: "MemoryTransport", callback, address: tuple, limit: int) -> None:
+
+        self.network: MemoryTransport = network
+        self.callback = callback
+        self.address: tuple = address
+        self.limit: int = limit
+        self.sockets: tuple = ()
+        self.closed: asyncio.Event = asyncio.Event()
+
+
+    def is_serving(self) -> bool:
+        return not self.closed.is_set()
+
+
+    def close(self) -> None:
+        if self.network.servers.get(self.address) is self:
+            self.network.servers.pop(self.address)
+        self.closed.set()
+
+
+    async def wait_closed(self) -> None:
+        await self.closed.wait()
+
+
+    async def serve_forever(self) -> None:
+        await self.closed.wait()
+
+
+    async def __aenter__(self) -> "MemoryServer":
+        return self
+
+
+    async def __aexit__(self, *exc) -> None:
+        self.close()
+        await self.wait_closed()
+
+
+class MemoryTransport(Transport):
+    """
+    Class that implements an in-memory network, used instead of TCP to run 
+        many clients in one process. Data sent in each direction of a 
+        connection arrives in order, after latency seconds plus the time it 
+        takes at the bandwidth of the receiving address. dropRate is the 
+        chance of each write resetting its connection, drawn from a random 
+        generator seeded with seed so runs can be repeated. While a side 
+        doesn't read, data sent to it stays with the sender, whose writing 
+        is paused once its buffer fills, as with TCP
+    """
+    def __init__(self, latency: float = 0.0, bandwidth: float | None = None, 
+                dropRate: float = 0.0, seed: int = 0) -> None:
+
+        self.latency: float = latency
+        self.bandwidth: float | None = bandwidth # bytes per second, None is unlimited
+        self.bandwidths: dict[tuple, float] = {} # receiving address -> bytes per second
+        self.dropRate: float = dropRate
+        self.random: random.Random = random.Random(seed)
+        self.servers: dict[tuple, MemoryServer] = {}
+        self.lastPort: int = 40000
+        self.inFlight: int = 0 # pieces of data sent and not delivered yet
+
+
+    def set_bandwidth(self, address: tuple, bandwidth: float | None) -> None:
+        """
+        Function to limit how fast an address receives data, to simulate 
+            a slow consumer
+        Args:
+            - address: (host, port) of the receiving side
+            - bandwidth: bytes per second, None to use the network default
+        """
+        if bandwidth == None:
+            self.bandwidths.pop(address, None)
+        else:
+            self.bandwidths[address] = bandwidth
+
+
+    async def open_connection(self, host: str, port: int, limit: int = 2 ** 16) -> tuple:
+        server: MemoryServer | None = self.servers.get((host, port))
+        if server == None:
+            raise ConnectionRefusedError(f"Nothing listening on {host}:{port}")
+
+        await asyncio.sleep(self.latency)
+
+        self.lastPort = self.lastPort + 1
+        clientAddress: tuple = ('127.0.0.1', self.lastPort)
+        loop = asyncio.get_running_loop()
+
+        reader = asyncio.StreamReader(limit=limit, loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        serverProtocol = asyncio.StreamReaderProtocol(asyncio.StreamReader(limit=server.limit, loop=loop), 
+                                                    server.callback, loop=loop)
+
+        clientSide: MemoryConnection = MemoryConnection(self, protocol, clientAddress, server.address)
+        serverSide: MemoryConnection = MemoryConnection(self, serverProtocol, server.address, clientAddress)
+        clientSide.peer = serverSide
+        serverSide.peer = clientSide
+
+        protocol.connection_made(clientSide)
+        serverProtocol.connection_made(serverSide)
+
+        return reader, asyncio.StreamWriter(clientSide, protocol, reader, loop)
+
+
+    async def start_server(self, callback, host: str, port: int, limit: int = 2 ** 16) -> MemoryServer:
+        if (host, port) in self.servers:
+            raise OSError(f"Address {host}:{port} already in use")
+
+        server: MemoryServer = MemoryServer(self, callback, (host, port), limit)
+        self.servers[(host, port)] = server
+        return server
+
+
+    def send(self, connection: MemoryConnection, data: bytes | None) -> None:
+        """
+        Function to put data, or EOF when None, on the way to the peer of 
+            a connection
+        Args:
+            - connection: side of the connection that is writing
+            - data: bytes written or None for EOF
+        """
+        if data != None and self.dropRate > 0 and self.random.random() < self.dropRate:
+            self.reset(connection)
+            return
+
+        loop = asyncio.get_running_loop()
+        arrival: float = loop.time() + self.latency
+        if connection.pending:
+            arrival = max(arrival, connection.pending[-1][0])
+
+        bandwidth: float | None = self.bandwidths.get(connection.get_extra_info('peername'), self.bandwidth)
+        if data != None and bandwidth != None:
+            arrival += len(data) / bandwidth
+
+        connection.pending.append((arrival, data))
+        self.inFlight += 1
+        if data != None:
+            connection.buffered += len(data)
+            if not connection.writingPaused and connection.buffered > connection.highWater:
+                connection.writingPaused = True
+                connection.protocol.pause_writing()
+
+        # Only the oldest data has a timer, so every direction stays in order
+        if len(connection.pending) == 1:
+            loop.call_at(arrival, self.deliver, connection)
+
+
+    def deliver(self, connection: MemoryConnection) -> None:
+        """
+        Function to hand the oldest pending data of a connection to its peer
+        Args:
+            - connection: side of the connection that wrote the data
+        """
+        if not connection.pending: return
+
+        # Keep the data on the sender until the peer reads again
+        if connection.peer.readingPaused and not connection.peer.lost:
+            connection.stalledAt = asyncio.get_running_loop().time()
+            return
+
+        _, data = connection.pending.popleft()
+        self.inFlight -= 1
+
+        if data != None:
+            connection.buffered -= len(data)
+            if connection.writingPaused and connection.buffered <= connection.lowWater:
+                connection.writingPaused = False
+                connection.protocol.resume_writing()
+
+        if connection.pending:
+            asyncio.get_running_loop().call_at(connection.pending[0][0], self.deliver, connection)
+
+        connection.peer.receive(data)
+
+        # A closed side is gone once its last data, the EOF, was delivered
+        if data == None:
+            connection.connection_lost(None)
+
+
+    def unstall(self, connection: MemoryConnection) -> None:
+        """
+        Function to resume delivering the data of a connection after its 
+            peer started reading again. Arrivals are delayed by the time 
+            the data waited, so the bandwidth limits still hold
+        Args:
+            - connection: side of the connection that wrote the data
+        """
+        if connection.stalledAt == None or connection.lost: return
+        loop = asyncio.get_running_loop()
+        delay: float = loop.time() - connection.stalledAt
+        connection.stalledAt = None
+
+        connection.pending = deque((arrival + delay, data) for arrival, data in connection.pending)
+        if connection.pending:
+            loop.call_at(connection.pending[0][0], self.deliver, connection)
+
+
+    def close(self, connection: MemoryConnection) -> None:
+        """
+        Function to close a connection once its pending data is delivered
+        Args:
+            - connection: side of the connection that is closing
+        """
+        if connection.lost: return
+        self.send(connection, None)
+
+
+    def reset(self, connection: MemoryConnection) -> None:
+        """
+        Function to break a connection at once, like a network failure
+        Args:
+            - connection: side of the connection that failed
+        """
+        peer: MemoryConnection = connection.peer
+        connection.connection_lost(None)
+        peer.connection_lost(ConnectionResetError("Connection reset by peer"))
+
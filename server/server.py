@@ -5,6 +5,7 @@ import asyncio
 import argparse
 import logging
 import os
+import secrets
 import sys
 from datetime import datetime
 from attr import dataclass
@@ -26,6 +27,8 @@ sys.path.append(parent)
 import common.communication as comms
 import common.utils as util
 
+logger: logging.Logger = logging.getLogger("Monitor")
+
 @dataclass
 class ClientValues:
     """
@@ -36,6 +39,8 @@ class ClientValues:
     nick: str
     ip: str
     port: int
+    token: str = ""
+    datagramAddr: tuple | None = None
 
 @dataclass
 class ServerValues:
@@ -46,8 +51,29 @@ class ServerValues:
     ip: str
     port: int
 
+@dataclass
+class Transfer:
+    """
+    Class used to store a stream being relayed by the server
+    """
+    sender: int
+    stream: int
+    recipients: set[asyncio.streams.StreamWriter]
+
 INVALID_SEQ_NUMBER: int = -1
 
+class DatagramRelay(asyncio.DatagramProtocol):
+    """
+    Class used to receive the datagrams sent to the server
+    """
+    def __init__(self, server: "Server") -> None:
+
+        self.server: Server = server
+
+
+    def datagram_received(self, data: bytes, addr: tuple) -> None:
+        self.server.process_datagram(data, addr)
+
 def find_seq_number_by_stream_reader(stream: asyncio.streams.StreamReader, streams: dict[int,ClientValues]) -> int:
     """
     Function to get the identification number of a given StreamReader
@@ -87,51 +113,139 @@ async def send_to_everyone(streams: dict[int,ClientValues], exceptions: list[asy
         - exceptions: list with all the exception streams
         - payload: data to send
     """
-    for ids in streams.keys():
-        streamWriter : asyncio.streams.StreamWriter = streams[ids].writer
-        if streamWriter not in exceptions:
-            await comms.send_dict(streamWriter, payload) 
+    byteData: bytes = await comms.encode_dict(payload)
+    writers: list[asyncio.streams.StreamWriter] = [streams[ids].writer for ids in streams.keys() 
+                                                    if streams[ids].writer not in exceptions]
+    await comms.broadcast_encoded(writers, byteData, comms.priority_of(payload))
 
 
 class Server:
     """
     Class that enables the server
     """
-    def __init__(self, maxClients: int) -> None:
-
+    def __init__(self, maxClients: int, transport: comms.Transport | None = None) -> None:
+        """
+        Args:
+            - maxClients: Maximum number of clients
+            - transport: Transport used to accept clients, sockets by default
+        """
         self.maxClients: int = maxClients
+        self.transport: comms.Transport = transport if transport != None else comms.SocketTransport()
         self.clients: dict[int, ClientValues] = {} # 
         self.server: ServerValues | None = None
         self.lastId: int = 1
+        self.transfers: dict[tuple[int, int], Transfer] = {} # (sender Id, client stream Id)
+        self.lastStream: int = 1
+        self.datagram: asyncio.DatagramTransport | None = None
+        self.datagramPort: int = 0
+        self.tokens: dict[str, int] = {} # token -> client Id
+        self.datagramClients: dict[tuple, int] = {} # bound address -> client Id
         
 
     async def create_server(self, ip: str, port: int) -> asyncio.base_events.Server:
         """
         Function that uses class values to create a Server with the 
-            designated Ip address and Port
+            designated Ip address and Port. It can be called again to also 
+            listen on other addresses, all clients share the same registry
         Args:
-            - ip: Ip address of the Server
-            - port: Port of the Server to operate on
+            - ip: Ip address of the Server, or "unix:<path>" to listen on 
+                a Unix domain socket
+            - port: Port of the Server to operate on, ignored for Unix 
+                domain sockets
         Returns:
             - Asyncio Server object
         Raises:
-            - ValueError: if Server was already established
             - TypeError: if supplied  attributes are not of correct type  
             - OSError: if connection wasn't established (handled by 
-            asyncio.open_connection function)
+            the transport)
         """
-        if self.server != None: raise ValueError(f"Server already defined")
-
         if not isinstance(ip, str) or not isinstance(port, int):
             raise TypeError("Wrong usage. Use (str, int) types")
         
-        server = await asyncio.start_server(
+        server = await self.transport.start_server(
                                         self.handle_client, 
                                         ip, 
                                         port
                                         )
 
         return server
+
+
+    async def create_datagram_endpoint(self, ip: str, port: int) -> asyncio.DatagramTransport:
+        """
+        Function to open the UDP endpoint, used beside the server for 
+            unreliable messages of clients that joined over it
+        Args:
+            - ip: Ip address to bind to
+            - port: UDP port to bind to, 0 picks a free one
+        Returns:
+            - Asyncio DatagramTransport object
+        Raises:
+            - ValueError: if the endpoint was already opened
+            - TypeError: if supplied  attributes are not of correct type  
+            - OSError: if the port couldn't be bound
+        """
+        if self.datagram != None: raise ValueError(f"Datagram endpoint already defined")
+
+        if not isinstance(ip, str) or not isinstance(port, int):
+            raise TypeError("Wrong usage. Use (str, int) types")
+
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: DatagramRelay(self), local_addr=(ip, port))
+        self.datagram = transport
+        self.datagramPort = transport.get_extra_info('sockname')[1]
+
+        return transport
+
+
+    def process_datagram(self, data: bytes, addr: tuple) -> None:
+        """
+        Function used to process a datagram. Binds the sender address to a 
+            client or relays its message to the other bound clients
+        Args:
+            - data: datagram received
+            - addr: address of the sender
+        """
+        msg: dict | None = comms.decode_datagram(data)
+        if msg == None:
+            logger.debug(f"Dropped invalid or oversize datagram from {addr}")
+            return
+
+        try:
+            util.check_dict_fields(msg, ['option'])
+
+            # {"option": "bind", "token": token} -> Bind message
+            if msg["option"] == "bind":
+                util.check_dict_fields(msg, ['token'])
+                seq: int = self.tokens.get(msg['token'], INVALID_SEQ_NUMBER)
+                if seq != INVALID_SEQ_NUMBER:
+                    client: ClientValues = self.clients[seq]
+                    if client.datagramAddr != None:
+                        self.datagramClients.pop(client.datagramAddr, None)
+                    client.datagramAddr = addr
+                    self.datagramClients[addr] = seq
+                    # Acknowledged every time, since an earlier ack may be lost
+                    self.datagram.sendto(comms.encode_datagram({"option": "bound"}), addr)
+                    logger.info(f"Client {client.nick} bound datagrams to {addr}")
+                else:
+                    logger.debug(f"Unknown token, message: {msg}")
+
+            # {"option": "message", "message": message, "nick": nick} -> Message message
+            elif msg["option"] == "message":
+                util.check_dict_fields(msg, ['message', 'nick'])
+                seq: int = self.datagramClients.get(addr, INVALID_SEQ_NUMBER)
+                if seq != INVALID_SEQ_NUMBER and self.clients[seq].nick == msg['nick']:
+                    for ids in self.clients.keys():
+                        client: ClientValues = self.clients[ids]
+                        if ids != seq and client.datagramAddr != None:
+                            self.datagram.sendto(data, client.datagramAddr)
+                else:
+                    logger.debug(f"Datagram from unbound address {addr}, message: {msg}")
+
+            else:
+                logger.debug("Unknow datagram option: " + str(msg['option']))
+        except ValueError as e:
+            logger.debug("Datagram not in the correct type")
     
 
     async def new_client(self, msg: dict, reader: asyncio.streams.StreamReader, 
@@ -154,16 +268,33 @@ class Server:
                 util.check_dict_fields(msg, ['nick', 'ip', 'port'])
                 if [client for client in self.clients if self.clients[client].nick == msg['nick']] == []:
                     
-                    # Give the new client all current clients
-                    for ids in self.clients.keys():
-                        client: ClientValues = self.clients[ids]
+                    # Give the new client all current clients. The joins are
+                    # queued as a single CONTROL frame before registering,
+                    # without yielding, so no broadcast reaches the client
+                    # ahead of the join of its sender, and clients joining
+                    # meanwhile send their join here
+                    roster: list[bytes] = []
+                    for client in self.clients.values():
                         joinMsg: dict = {"option": "join", "nick": client.nick, "ip": client.ip, "port": client.port}
                         logger.debug(f"Sending to {writer.get_extra_info('peername')}: {joinMsg}")
-                        await comms.send_dict(writer, joinMsg)
-
+                        byteData: bytes = comms.json_to_bytes(joinMsg)
+                        roster += [len(byteData).to_bytes(4, 'big'), byteData]
+                    sent: asyncio.Future | None = comms.get_outbox(writer).put(writer, roster, comms.CONTROL) if roster else None
 
-                    self.clients[self.lastId] = (ClientValues(writer, reader, msg["nick"], msg["ip"], msg["port"]))
+                    seq: int = self.lastId
+                    self.clients[seq] = (ClientValues(writer, reader, msg["nick"], msg["ip"], msg["port"]))
                     self.lastId = self.lastId + 1
+
+                    if sent != None: await sent
+
+                    # Offer the datagram channel, only the new client gets its token
+                    if self.datagram != None:
+                        token: str = secrets.token_hex(16)
+                        self.clients[seq].token = token
+                        self.tokens[token] = seq
+                        offerMsg: dict = {"option": "datagram", "token": token, "port": self.datagramPort}
+                        await comms.send_dict(writer, offerMsg)
+
                     logger.warning(f"Client {msg['nick']} with {msg['ip']}:{msg['port']} has entered")
                     return msg
                 else:
@@ -177,11 +308,12 @@ class Server:
         return None
         
 
-    async def process_client(self, msg: dict) ->  dict | None:
+    async def process_client(self, msg: dict, seq: int = INVALID_SEQ_NUMBER) ->  dict | None:
         """
         Function used to process a message 
         Args:
             - msg: message sent by the client
+            - seq: identification number of the client that sent the message
         Returns:
             - A dictionary object to send to all clients, excluding the 
                 client that sent the message, or None in case it is 
@@ -199,6 +331,31 @@ class Server:
                 else:
                     logger.debug(f"Client not registered, message: {msg}")
 
+            # {"option": "stream_start", "nick": nick, "stream": stream, "name": name} -> Stream start message
+            elif msg["option"] == "stream_start":
+                util.check_dict_fields(msg, ['nick', 'stream', 'name'])
+                if seq in self.clients and self.clients[seq].nick == msg['nick'] \
+                        and comms.is_stream_id(msg['stream']) and (seq, msg['stream']) not in self.transfers:
+                    recipients: set[asyncio.streams.StreamWriter] = {
+                        self.clients[ids].writer for ids in self.clients.keys() if ids != seq}
+                    transfer: Transfer = Transfer(seq, self.new_stream(), recipients)
+                    self.transfers[(seq, msg['stream'])] = transfer
+                    logger.info(f"Client {msg['nick']} started streaming {msg['name']}")
+                    return {**msg, "stream": transfer.stream}
+                else:
+                    logger.debug(f"Stream not accepted, message: {msg}")
+
+            # {"option": "stream_end", "nick": nick, "stream": stream} -> Stream end message
+            elif msg["option"] == "stream_end":
+                util.check_dict_fields(msg, ['nick', 'stream'])
+                if seq in self.clients and self.clients[seq].nick == msg['nick'] \
+                        and comms.is_stream_id(msg['stream']) and (seq, msg['stream']) in self.transfers:
+                    transfer: Transfer = self.transfers.pop((seq, msg['stream']))
+                    logger.info(f"Client {msg['nick']} finished streaming")
+                    return {**msg, "stream": transfer.stream}
+                else:
+                    logger.debug(f"Stream not recognized, message: {msg}")
+
             else:
                 logger.debug("Unknow message option: " + str(msg['option']))
         except ValueError as e:
@@ -207,6 +364,56 @@ class Server:
         return None
 
 
+    def new_stream(self) -> int:
+        """
+        Function to get the stream Id of a new transfer, as seen by its 
+            recipients. Ids wrap around, skipping those still in use
+        Returns:
+            - stream Id
+        """
+        inUse: set[int] = {transfer.stream for transfer in self.transfers.values()}
+        while self.lastStream in inUse:
+            self.lastStream = comms.next_stream_id(self.lastStream)
+
+        stream: int = self.lastStream
+        self.lastStream = comms.next_stream_id(self.lastStream)
+        return stream
+
+
+    async def process_chunk(self, chunk: comms.Chunk, seq: int) -> None:
+        """
+        Function used to forward a chunk of a stream to its recipients as 
+            soon as it arrives. The sender is only read again once the 
+            slowest recipient took the chunk, which bounds the buffering of 
+            each transfer to one chunk plus the recipients write buffers
+        Args:
+            - chunk: chunk sent by the client
+            - seq: identification number of the client that sent the chunk
+        """
+        transfer: Transfer | None = self.transfers.get((seq, chunk.stream))
+        if transfer == None:
+            logger.debug(f"Chunk of unknown stream {chunk.stream} from {seq}")
+            return
+
+        # Recipients that left were already removed by disconnect_client
+        await comms.relay_chunk(list(transfer.recipients), transfer.stream, chunk.data)
+
+
+    async def abort_streams(self, seq: int) -> None:
+        """
+        Function used to cancel every stream of a client that left
+        Args:
+            - seq: identification number of the client
+        """
+        for key in [key for key in self.transfers.keys() if key[0] == seq]:
+            transfer: Transfer = self.transfers.pop(key)
+            response: dict = {"option": "stream_end", "nick": self.clients[seq].nick, 
+                                "stream": transfer.stream, "aborted": True}
+            logger.debug(f"Aborting stream: {response}")
+            for writer in transfer.recipients:
+                await comms.send_dict(writer, response)
+
+
     async def handle_client(self, reader : asyncio.streams.StreamReader, writer : asyncio.streams.StreamWriter) -> None:
         """
         Main function used to operate clients
@@ -214,9 +421,13 @@ class Server:
         try:
             while True:
 
-                msg = await comms.recv_dict(reader)
+                msg = await comms.recv_frame(reader)
                 if msg == None: break
 
+                if isinstance(msg, comms.Chunk):
+                    await self.process_chunk(msg, find_seq_number_by_stream_reader(reader, self.clients))
+                    continue
+
                 addr = writer.get_extra_info('peername')
 
                 logger.debug(f"Received: {msg!r} from {addr!r}")
@@ -232,7 +443,7 @@ class Server:
                         response: dict | None = await self.new_client(msg, reader, writer)
                 # Existing user
                 else:
-                    response: dict | None = await self.process_client(msg)           
+                    response: dict | None = await self.process_client(msg, seq)           
 
                 if response != None:
                     logger.debug(f"Sending to everyone, minus sender: {response}")
@@ -240,33 +451,72 @@ class Server:
 
         except OSError as e:
             logger.debug("Closed connection")
-            closedSeq: int = find_seq_number_by_stream_writer(writer , self.clients)
-            # New user
-            if seq == INVALID_SEQ_NUMBER:
-                logger.warning("Unregistered client disconnected")
-            # Existing user
-            else:
-                response: dict = {"option": "disconnect", "nick": self.clients[closedSeq].nick}
-                client: ClientValues = self.clients.pop(closedSeq)
-                logger.warning(f"Disconnecting {client.nick}")
-                logger.debug(f"Sending to everyone: {response}")
-                await send_to_everyone(self.clients, [], response)
+        finally:
+            # Forget the client however the handler ends
+            await self.disconnect_client(writer)
+
+
+    async def disconnect_client(self, writer: asyncio.streams.StreamWriter) -> None:
+        """
+        Function used to forget a client whose connection ended and tell 
+            everyone else that it left
+        Args:
+            - writer: Writer stream of the client
+        """
+        closedSeq: int = find_seq_number_by_stream_writer(writer , self.clients)
+        # New user
+        if closedSeq == INVALID_SEQ_NUMBER:
+            logger.warning("Unregistered client disconnected")
+        # Existing user
+        else:
+            await self.abort_streams(closedSeq)
+            response: dict = {"option": "disconnect", "nick": self.clients[closedSeq].nick}
+            client: ClientValues = self.clients.pop(closedSeq)
+            for transfer in self.transfers.values():
+                transfer.recipients.discard(writer)
+            self.tokens.pop(client.token, None)
+            if client.datagramAddr != None:
+                self.datagramClients.pop(client.datagramAddr, None)
+            logger.warning(f"Disconnecting {client.nick}")
+            logger.debug(f"Sending to everyone: {response}")
+            await send_to_everyone(self.clients, [], response)
+
+        writer.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--bind", help="IP address to bind to", default="127.0.0.1")
+    parser.add_argument("--bind", help="IP address to bind to, TCP and UDP", default="127.0.0.1")
     parser.add_argument("--port", help="TCP port", type=int, default=8005)
+    parser.add_argument("--unix", help="Path of a Unix domain socket to listen on too", 
+                            type=str, default=None)
+    parser.add_argument("--noTcp", help="Only listen on the Unix domain socket", 
+                            action='store_true')
+    parser.add_argument("--udpPort", help="UDP port for unreliable messages, disabled if not given", 
+                            type=int, default=None)
     parser.add_argument("--maxClients", help="Maximum number of clients", type=int, default=5)
     parser.add_argument("--log", help="Log threshold (default=INFO)", type=str, default='INFO')
+    parser.add_argument("--offloadThreshold", help="Messages bigger than this (bytes) are encoded/decoded in a worker pool", 
+                            type=int, default=comms.offload.threshold)
+    parser.add_argument("--offloadWorkers", help="Number of workers in the pool", 
+                            type=int, default=comms.offload.workers)
+    parser.add_argument("--offloadThreads", help="Use a thread pool instead of a process pool (only helps if encoding releases the GIL)", 
+                            action='store_true')
+    parser.add_argument("--controlBurst", help="Most join/disconnect messages sent in a row while chat messages wait", 
+                            type=int, default=comms.scheduling.controlBurst)
     args = parser.parse_args()
 
+    if args.noTcp and args.unix == None:
+        parser.error("--noTcp requires --unix")
+
+    comms.configure_offload(args.offloadThreshold, args.offloadWorkers, not args.offloadThreads)
+    comms.configure_scheduling(args.controlBurst)
+
     # check Logger value
     numericLogLeved = getattr(logging, args.log.upper(), None)
     if not isinstance(numericLogLeved, int):
         raise ValueError('Invalid log level: %s' % numericLogLeved)
 
-    # Creating an object
-    logger: logging.Logger= logging.getLogger("Monitor")
+    # Configure the module logger
     logger.setLevel(logging.DEBUG)
 
     # create console handler and set level to log argument
@@ -288,22 +538,31 @@ if __name__ == "__main__":
     # add fh to logger
     logger.addHandler(fh)
 
-    async def main(ip: str, port: int, maxClients: int) -> None:
+    async def main(ip: str, port: int, maxClients: int, udpPort: int | None, 
+                unixPath: str | None, tcp: bool) -> None:
 
         # Create the server class
         server: Server = Server(maxClients)
 
-        # Create the server
-        serverObj: asyncio.base_events.Server = await server.create_server(ip, port)
+        # Create the servers, they share the same clients
+        serverObjs: list[asyncio.base_events.Server] = []
+        if tcp:
+            serverObjs.append(await server.create_server(ip, port))
+        if unixPath != None:
+            serverObjs.append(await server.create_server(comms.UNIX_PREFIX + unixPath, 0))
 
-        addrs = ', '.join(str(sock.getsockname()) for sock in serverObj.sockets)
+        addrs = ', '.join(str(sock.getsockname()) for serverObj in serverObjs for sock in serverObj.sockets)
         logger.info(f'Serving on {addrs}')
 
-        async with serverObj:
-            await serverObj.serve_forever()
+        # Open the datagram endpoint
+        if udpPort != None:
+            await server.create_datagram_endpoint(ip, udpPort)
+            logger.info(f'Datagrams on {(ip, server.datagramPort)}')
+
+        await asyncio.gather(*(serverObj.serve_forever() for serverObj in serverObjs))
 
     try:
-        asyncio.run(main(args.bind, args.port, args.maxClients))
+        asyncio.run(main(args.bind, args.port, args.maxClients, args.udpPort, args.unix, not args.noTcp))
     except KeyboardInterrupt:
         logger.error("\Server Terminated")
     except OSError as e:
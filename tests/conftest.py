@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import pytest
+import common.communication as comms
+from server.server import Server
+from tests.simulation import SimClient
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="run the tests marked as slow")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: big scenario that takes a minute, run with --runslow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"): return
+    skipSlow = pytest.mark.skip(reason="slow, run with --runslow")
+    for item in items:
+        if "slow" in item.keywords: item.add_marker(skipSlow)
+
+
+@pytest.fixture
+def anyio_backend():
+    return 'asyncio'
+
+
+@pytest.fixture(autouse=True)
+def quiet_monitor():
+    """ The server warns about every join and disconnect, keep it quiet during a test only """
+    logger = logging.getLogger("Monitor")
+    previous = logger.level
+    logger.setLevel(logging.ERROR)
+    yield
+    logger.setLevel(previous)
+
+
+async def eventually(condition, timeout=2.0):
+    """ Wait until condition() is true, data takes a moment on sockets """
+    for _ in range(int(timeout / 0.01)):
+        if condition(): return
+        await asyncio.sleep(0.01)
+    assert condition()
+
+
+async def start_server(datagrams=False):
+    server = Server(10)
+    tcp = await server.create_server('127.0.0.1', 0)
+    if datagrams: await server.create_datagram_endpoint('127.0.0.1', 0)
+    return server, tcp, tcp.sockets[0].getsockname()[1]
+
+
+async def join(nick, port, host='127.0.0.1', datagrams=False, streamSink=None):
+    client = SimClient(nick, comms.SocketTransport(), datagrams)
+    if streamSink != None: client.streamSink = streamSink
+    await client.connect_client(host, port)
+    client.task = asyncio.create_task(client.receive_client())
+    return client
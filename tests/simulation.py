@@ -0,0 +1,216 @@
+"""
+`simulation` runs the server and many clients over a MemoryTransport, on an
+    event loop with a virtual clock, so big scenarios run in seconds and give
+    the same result every time
+"""
+import asyncio
+import math
+import selectors
+
+from client.client import Client
+from server.server import Server
+import common.communication as comms
+
+HOST: str = '127.0.0.1'
+PORT: int = 8005
+SETTLE_TIME: float = 60.0
+"""Virtual seconds waited at a time for the network to go quiet, they cost nothing"""
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """
+    Class used to move the virtual clock forward instead of blocking when
+        the loop has nothing to do until its next timer
+    """
+    def __init__(self, loop: "SimulatedLoop") -> None:
+        super().__init__()
+        self.loop: SimulatedLoop = loop
+
+
+    def select(self, timeout: float | None = None) -> list:
+        events: list = super().select(0)
+        if events or timeout == 0: return events
+
+        if timeout == None:
+            # Only another thread (e.g. the offload pool) can wake the loop now
+            events = super().select(5.0)
+            if not events: raise RuntimeError("Simulation stalled, nothing left to run")
+            return events
+
+        # Always move forward, even when timeout is below the clock precision
+        self.loop.now = max(self.loop.now + timeout, math.nextafter(self.loop.now, math.inf))
+        return events
+
+
+class SimulatedLoop(asyncio.SelectorEventLoop):
+    """
+    Class that implements an event loop whose clock only moves when every
+        task is waiting on a timer
+    """
+    def __init__(self) -> None:
+        self.now: float = 0.0
+        super().__init__(VirtualSelector(self))
+
+
+    def time(self) -> float:
+        return self.now
+
+
+def run_simulation(main):
+    """
+    Function to run a coroutine on a SimulatedLoop
+    Args:
+        - main: coroutine to run
+    Returns:
+        - Value returned by the coroutine
+    """
+    loop: SimulatedLoop = SimulatedLoop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        # Stop the server handlers and clients still running, like asyncio.run
+        pending: set[asyncio.Task] = asyncio.all_tasks(loop)
+        for task in pending: task.cancel()
+        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class SimClient(Client):
+    """
+    Class used to represent a client that keeps every message it receives
+    """
+    def __init__(self, nick: str, transport: comms.Transport, datagrams: bool = False) -> None:
+        super().__init__(nick, transport=transport, datagrams=datagrams)
+        self.received: list[dict] = []
+        self.task: asyncio.Task | None = None
+
+
+    def process_message(self, msg: dict) -> None:
+        self.received.append(msg)
+        super().process_message(msg)
+
+
+    def messages(self) -> list[tuple]:
+        """
+        Function to get the chat messages received
+        Returns:
+            - list of (nick, message) in the order they arrived
+        """
+        return [(msg['nick'], msg['message']) for msg in self.received if msg.get('option') == 'message']
+
+
+    def peers(self) -> set[str]:
+        """
+        Function to get the nicks this client believes are connected
+        Returns:
+            - set of nicks
+        """
+        return set(self.clients.keys())
+
+
+class Simulation:
+    """
+    Class used to run a server and its clients over an in-memory network
+    """
+    def __init__(self, maxClients: int = 100000, latency: float = 0.0,
+                bandwidth: float | None = None, dropRate: float = 0.0, seed: int = 0) -> None:
+        """
+        Args:
+            - maxClients: Maximum number of clients of the server
+            - latency: seconds each piece of data takes to arrive
+            - bandwidth: bytes per second of every link, None is unlimited
+            - dropRate: chance of each write resetting its connection
+            - seed: seed of the random generator used for drops
+        """
+        self.network: comms.MemoryTransport = comms.MemoryTransport(latency, bandwidth, dropRate, seed)
+        self.server: Server = Server(maxClients, self.network)
+        self.clients: dict[str, SimClient] = {}
+
+
+    async def start(self) -> None:
+        """
+        Function to start the server
+        """
+        await self.server.create_server(HOST, PORT)
+
+
+    async def settle(self) -> None:
+        """
+        Function to wait until everything sent so far was delivered
+        """
+        await asyncio.sleep(SETTLE_TIME)
+        while self.network.inFlight > 0:
+            await asyncio.sleep(SETTLE_TIME)
+
+
+    async def stop(self) -> None:
+        """
+        Function to disconnect every client and wait for the server to 
+            forget them
+        """
+        for client in list(self.clients.values()):
+            await self.disconnect(client)
+        await self.settle()
+
+
+    async def join(self, nicks: list[str]) -> list[SimClient]:
+        """
+        Function to connect new clients and send their join messages
+        Args:
+            - nicks: nicks of the clients
+        Returns:
+            - list with the new clients
+        """
+        joined: list[SimClient] = []
+        for nick in nicks:
+            client: SimClient = SimClient(nick, self.network)
+            await client.connect_client(HOST, PORT)
+            client.task = asyncio.create_task(client.receive_client())
+            self.clients[nick] = client
+            joined.append(client)
+        return joined
+
+
+    async def broadcast(self, client: SimClient, message: str) -> bool:
+        """
+        Function to send a chat message from a client
+        Args:
+            - client: client sending the message
+            - message: text of the message
+        Returns:
+            - True if the message was sent, false otherwise
+        """
+        msg: dict = {"option": "message", "message": message, "nick": client.nick}
+        return await comms.send_dict(client.connection.writer, msg)
+
+
+    async def disconnect(self, client: SimClient) -> None:
+        """
+        Function to close the connection of a client
+        Args:
+            - client: client leaving
+        """
+        client.connection.writer.close()
+        self.clients.pop(client.nick, None)
+
+
+    def slow_down(self, client: SimClient, bandwidth: float | None) -> None:
+        """
+        Function to limit how fast a client receives data
+        Args:
+            - client: client to slow down
+            - bandwidth: bytes per second, None to remove the limit
+        """
+        self.network.set_bandwidth(client.connection.writer.get_extra_info('sockname'), bandwidth)
+
+
+    def connected(self) -> list[SimClient]:
+        """
+        Function to get the clients whose connection is still up
+        Returns:
+            - list of clients
+        """
+        return [client for client in self.clients.values() if not client.task.done()]
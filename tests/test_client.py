@@ -0,0 +1,26 @@
+import os
+from client.client import safe_file_name, download_path
+
+
+def test_safe_file_name():
+    assert safe_file_name("report.pdf") == "report.pdf"
+    assert safe_file_name("../../.ssh/authorized") == "authorized"
+    assert safe_file_name("a b/c;d") == "c_d"
+    assert safe_file_name("..") == "_"
+    assert safe_file_name("") == "_"
+
+
+def test_download_path_stays_in_folder(tmp_path):
+    folder = str(tmp_path)
+    msg = {"nick": "../../.ssh/authorized", "name": "keys"}
+    assert download_path(folder, msg) == os.path.join(os.path.realpath(folder), "authorized_keys")
+
+    msg = {"nick": "..", "name": "/etc/passwd"}
+    assert download_path(folder, msg) == os.path.join(os.path.realpath(folder), "__passwd")
+
+
+def test_download_path_refuses_links_out_of_folder(tmp_path):
+    folder = tmp_path / "downloads"
+    folder.mkdir()
+    os.symlink(tmp_path, folder / "alice_x")
+    assert download_path(str(folder), {"nick": "alice", "name": "x"}) == None
@@ -1,5 +1,12 @@
+import gc
+import io
+import socket
+import weakref
+import asyncio
 import pytest
-from common.communication import json_to_bytes, bytes_to_json, send_dict
+import common.communication as comms
+from common.communication import json_to_bytes, bytes_to_json, send_dict, exact_recv, \
+    recv_dict, recv_frame, send_stream, chunk_header, encode_dict, Chunk, MAX_CHUNK_SIZE
 
 def test_json_to_bytes():
     dictObj = {'key1': 1, 'key2': 'value2'}
@@ -23,3 +30,205 @@ async def test_send_dict_wrong_type():
 async def test_send_dict_wrong_json():
     with pytest.raises(TypeError):
         await send_dict(None, 'invalid json')
+
+
+class FakeTransport:
+    """ Transport whose write buffer has whatever size is set """
+    def __init__(self, size=0):
+        self.size = size
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return self.size
+
+    def get_write_buffer_limits(self):
+        return (16 * 1024, 64 * 1024)
+
+
+class BufferWriter:
+    """ Minimal writer that keeps everything written to it """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.transport = FakeTransport()
+
+    def writelines(self, data):
+        for item in data:
+            self.buffer += item
+
+    async def drain(self):
+        pass
+
+
+@pytest.mark.anyio
+async def test_exact_recv_partial_reads():
+    reader = asyncio.StreamReader()
+    for piece in (b'abc', b'de', b'fg', b'hij'):
+        reader.feed_data(piece)
+    assert await exact_recv(reader, 10) == b'abcdefghij'
+
+
+@pytest.mark.anyio
+async def test_recv_frame_chunk():
+    reader = asyncio.StreamReader()
+    reader.feed_data(chunk_header(7, 5) + b'hello')
+    chunk = await recv_frame(reader)
+    assert isinstance(chunk, Chunk)
+    assert chunk.stream == 7
+    assert bytes(chunk.data) == b'hello'
+
+
+@pytest.mark.anyio
+async def test_recv_frame_chunk_too_big():
+    reader = asyncio.StreamReader()
+    reader.feed_data(chunk_header(1, MAX_CHUNK_SIZE + 1))
+    assert await recv_frame(reader) == None
+
+
+@pytest.mark.anyio
+async def test_send_stream_and_recv_dict_skips_chunks():
+    writer = BufferWriter()
+    assert await send_stream(writer, 3, io.BytesIO(b'x' * 10), chunkSize=4)
+
+    reader = asyncio.StreamReader()
+    reader.feed_data(bytes(writer.buffer))
+    received = bytearray()
+    for _ in range(3):
+        chunk = await recv_frame(reader)
+        assert chunk.stream == 3
+        received += chunk.data
+    assert received == b'x' * 10
+
+    byteData = json_to_bytes({'key1': 'value1'})
+    reader.feed_data(bytes(writer.buffer) + len(byteData).to_bytes(4, 'big') + byteData)
+    assert await recv_dict(reader) == {'key1': 'value1'}
+
+
+@pytest.fixture
+def low_offload_threshold():
+    previous = comms.offload.threshold
+    comms.configure_offload(threshold=64)
+    yield
+    comms.configure_offload(threshold=previous)
+
+
+def test_configure_offload_invalid():
+    with pytest.raises(ValueError):
+        comms.configure_offload(threshold=-1)
+    with pytest.raises(ValueError):
+        comms.configure_offload(workers=0)
+
+
+@pytest.mark.anyio
+async def test_offloaded_frames_keep_order(low_offload_threshold):
+    first, second = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=first)
+    reader, peerWriter = await asyncio.open_connection(sock=second)
+
+    bigMsg = {'option': 'message', 'message': 'x' * 100000}
+    smallMsg = {'option': 'message', 'message': 'y'}
+    assert await encode_dict(bigMsg) == json_to_bytes(bigMsg)
+
+    # The small message is issued last and must not overtake the big one
+    await asyncio.gather(send_dict(writer, bigMsg), send_dict(writer, smallMsg))
+    assert await recv_dict(reader) == bigMsg
+    assert await recv_dict(reader) == smallMsg
+
+    writer.close(); peerWriter.close()
+
+
+class BlockingWriter(BufferWriter):
+    """ Writer whose drain blocks until released, to build a backlog """
+    def __init__(self):
+        super().__init__()
+        self.frames = []
+        self.released = asyncio.Event()
+        self.transport = FakeTransport(size=1024 * 1024)
+
+    def writelines(self, data):
+        self.frames.append(b''.join(data))
+
+    async def drain(self):
+        await self.released.wait()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("controlBurst, expected", [
+    (16, [b'd1', b'c1', b'c2', b'c3', b'd2', b'd3']),
+    (1, [b'd1', b'c1', b'd2', b'c2', b'd3', b'c3']),
+])
+async def test_outbox_priorities(controlBurst, expected):
+    previous = comms.scheduling.controlBurst
+    comms.configure_scheduling(controlBurst)
+    try:
+        writer = BlockingWriter()
+        outbox = comms.Outbox()
+        sent = [outbox.put(writer, [b'd1'], comms.DATA)]
+        await asyncio.sleep(0) # d1 is now waiting to drain
+        sent += [outbox.put(writer, [b'd2'], comms.DATA), outbox.put(writer, [b'd3'], comms.DATA)]
+        sent += [outbox.put(writer, [frame], comms.CONTROL) for frame in (b'c1', b'c2', b'c3')]
+
+        writer.released.set()
+        assert await asyncio.gather(*sent) == [True] * 6
+        assert writer.frames == expected
+    finally:
+        comms.configure_scheduling(previous)
+
+
+@pytest.mark.anyio
+async def test_outbox_writes_at_once_without_backlog():
+    writer = BufferWriter()
+    outbox = comms.Outbox()
+    sent = outbox.put(writer, [b'a', b'b'], comms.DATA)
+    assert sent.done() and sent.result() == True
+    assert writer.buffer == b'ab' and outbox.task == None
+
+    # Once the transport is above its high-water mark, frames are queued
+    writer.transport.size = 1024 * 1024
+    sent = outbox.put(writer, [b'c'], comms.DATA)
+    assert not sent.done() and outbox.task != None
+    assert await sent == True and writer.buffer == b'abc'
+
+
+def test_priority_of():
+    assert comms.priority_of({'option': 'join'}) == comms.CONTROL
+    assert comms.priority_of({'option': 'disconnect'}) == comms.CONTROL
+    assert comms.priority_of({'option': 'message'}) == comms.DATA
+
+
+@pytest.mark.anyio
+async def test_outbox_does_not_keep_writer_alive(low_offload_threshold):
+    # Frames go through the worker pool, so the writer gets a lock as well
+    first, second = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=first)
+    reader, peerWriter = await asyncio.open_connection(sock=second)
+
+    msg = {'option': 'message', 'message': 'x' * 1000}
+    assert await send_dict(writer, msg)
+    assert await recv_dict(reader) == msg
+    assert writer in comms.outboxes and writer in comms.sendLocks
+
+    writer.close(); await writer.wait_closed()
+    writerRef = weakref.ref(writer)
+    del writer
+    gc.collect()
+    assert writerRef() == None
+
+    peerWriter.close()
+
+
+@pytest.mark.anyio
+async def test_close_reaches_peer_after_offload_pool_started(low_offload_threshold):
+    first, second = socket.socketpair()
+    reader, writer = await asyncio.open_connection(sock=first)
+    peerReader, peerWriter = await asyncio.open_connection(sock=second)
+
+    # The pool is started while both sockets are open
+    bigMsg = {'option': 'message', 'message': 'x' * 100000}
+    await send_dict(peerWriter, bigMsg)
+    assert await recv_dict(reader) == bigMsg
+
+    writer.close(); await writer.wait_closed()
+    assert await asyncio.wait_for(peerReader.read(1), 2.0) == b''
+    peerWriter.close()
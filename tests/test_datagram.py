@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import socket
+import pytest
+import common.communication as comms
+from tests.conftest import eventually, start_server, join
+
+
+@pytest.mark.anyio
+async def test_datagrams_relayed_to_bound_clients():
+    server, tcp, port = await start_server(datagrams=True)
+    alice = await join("alice", port, datagrams=True)
+    bob = await join("bob", port, datagrams=True)
+    carol = await join("carol", port)
+    await eventually(lambda: alice.datagramBound.is_set() and bob.datagramBound.is_set())
+    await eventually(lambda: len(alice.peers()) == 2 and len(bob.peers()) == 2)
+
+    assert await alice.send_datagram("hello")
+    await eventually(lambda: bob.messages() == [("alice", "hello")])
+    await asyncio.sleep(0.05)
+    assert carol.messages() == [] and alice.messages() == []
+
+    assert not await carol.send_datagram("no channel")
+    assert not await alice.send_datagram("x" * comms.MAX_DATAGRAM_SIZE)
+
+    for client in (alice, bob, carol):
+        client.connection.writer.close()
+    await eventually(lambda: server.clients == {} and server.datagramClients == {})
+    tcp.close(); server.datagram.close()
+
+
+@pytest.mark.anyio
+async def test_unbound_and_oversize_datagrams_dropped():
+    server, tcp, port = await start_server(datagrams=True)
+    alice = await join("alice", port, datagrams=True)
+    bob = await join("bob", port, datagrams=True)
+    await eventually(lambda: alice.datagramBound.is_set() and bob.datagramBound.is_set())
+    await eventually(lambda: len(bob.peers()) == 1)
+
+    # Right nick, but from an address that never bound a token
+    stranger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    msg = {"option": "message", "message": "spoofed", "nick": "alice"}
+    stranger.sendto(comms.json_to_bytes(msg), ('127.0.0.1', server.datagramPort))
+
+    # Oversize datagram from alice's bound address
+    aliceAddr = alice.datagram.get_extra_info('sockname')
+    server.process_datagram(comms.json_to_bytes({**msg, "message": "x" * comms.MAX_DATAGRAM_SIZE}), aliceAddr)
+
+    await asyncio.sleep(0.1)
+    assert bob.messages() == []
+
+    stranger.close()
+    for client in (alice, bob):
+        client.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close(); server.datagram.close()
+
+
+
+@pytest.mark.anyio
+async def test_failed_datagram_bind_is_logged(caplog, monkeypatch):
+    server, tcp, port = await start_server(datagrams=True)
+
+    async def refuse(*args, **kwargs):
+        raise OSError("no datagrams here")
+
+    monkeypatch.setattr(asyncio.get_running_loop(), "create_datagram_endpoint", refuse)
+    with caplog.at_level(logging.WARNING, logger="Monitor"):
+        alice = await join("alice", port, datagrams=True)
+        await eventually(lambda: alice.bindTask != None and alice.bindTask.done())
+    assert alice.bindTask.result() == False
+    assert "no datagrams here" in caplog.text
+
+    alice.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close(); server.datagram.close()
@@ -0,0 +1,210 @@
+import asyncio
+import io
+import pytest
+import common.communication as comms
+from tests.simulation import Simulation, run_simulation, HOST, PORT
+
+
+def check_views(sim: Simulation) -> None:
+    """ Every connected client sees exactly the clients registered on the server """
+    registered = {client.nick for client in sim.server.clients.values()}
+    connected = sim.connected()
+    assert {client.nick for client in connected} == registered
+    for client in connected:
+        assert client.peers() == registered - {client.nick}
+
+
+def test_memory_transport_refuses_unknown_address():
+    async def main():
+        with pytest.raises(ConnectionRefusedError):
+            await comms.MemoryTransport().open_connection(HOST, PORT)
+
+    run_simulation(main())
+
+
+def test_incomplete_transport_cannot_be_created():
+    class ClientOnly(comms.Transport):
+        async def open_connection(self, host, port):
+            return await comms.SocketTransport().open_connection(host, port)
+
+    with pytest.raises(TypeError):
+        ClientOnly()
+
+
+def test_10k_clients_join_and_leave_in_waves():
+    waveSize = 5
+
+    async def main():
+        sim = Simulation()
+        await sim.start()
+        for wave in range(10000 // waveSize):
+            clients = await sim.join([f"c{wave}_{i}" for i in range(waveSize)])
+            await sim.settle()
+            check_views(sim)
+
+            for client in clients:
+                await sim.broadcast(client, "first")
+                await sim.broadcast(client, "second")
+            await sim.settle()
+            for client in clients:
+                for other in clients:
+                    if other is client: continue
+                    assert [text for nick, text in client.messages() if nick == other.nick] == ["first", "second"]
+
+            for client in clients[:-1]:
+                await sim.disconnect(client)
+            await sim.settle()
+            check_views(sim)
+            await sim.disconnect(clients[-1])
+
+        await sim.settle()
+        assert sim.server.clients == {}
+
+    run_simulation(main())
+
+
+@pytest.mark.parametrize("nClients", [200, pytest.param(1000, marks=pytest.mark.slow)])
+def test_broadcast_with_many_clients_connected(nClients):
+    # Every join reaches every client, so joins cost N**2 frames, about a 
+    # million with 1000 clients
+    async def main():
+        sim = Simulation()
+        await sim.start()
+        clients = await sim.join([f"c{i}" for i in range(nClients)])
+        await sim.settle()
+        check_views(sim)
+
+        senders = clients[::50]
+        for client in senders:
+            await sim.broadcast(client, "first")
+            await sim.broadcast(client, "second")
+        await sim.settle()
+        for client in clients:
+            others = [sender for sender in senders if sender is not client]
+            messages = client.messages()
+            assert len(messages) == 2 * len(others)
+            for sender in others:
+                assert [text for nick, text in messages if nick == sender.nick] == ["first", "second"]
+
+        for client in clients[:-1]:
+            await sim.disconnect(client)
+        await sim.settle()
+        check_views(sim)
+        assert clients[-1].peers() == set()
+        await sim.disconnect(clients[-1])
+        await sim.settle()
+        assert sim.server.clients == {}
+
+    run_simulation(main())
+
+
+def test_control_overtakes_backlog_of_slow_consumer():
+    async def main():
+        sim = Simulation(latency=0.005)
+        await sim.start()
+        senders = await sim.join([f"sender{i}" for i in range(100)])
+        slow, = await sim.join(["slow"])
+        await sim.settle()
+        sim.slow_down(slow, 10 * 1024)
+
+        async def burst(client):
+            for n in range(10):
+                await sim.broadcast(client, f"{n}:" + "x" * 1024)
+
+        bursts = [asyncio.create_task(burst(client)) for client in senders]
+        await asyncio.sleep(1)
+        await sim.join(["late"])
+        await asyncio.gather(*bursts)
+        await sim.settle()
+
+        options = [msg['option'] for msg in slow.received]
+        assert options.count('message') == 100 * 10
+        # Each sender has a message queued for the slow client, the join
+        # must only wait for what is already in the transport buffer
+        lateJoin = options.index('join', len(senders))
+        assert options[:lateJoin].count('message') < len(senders)
+        for sender in senders:
+            texts = [text for nick, text in slow.messages() if nick == sender.nick]
+            assert [int(text.split(':')[0]) for text in texts] == list(range(10))
+        await sim.stop()
+
+    run_simulation(main())
+
+
+def test_slow_consumer_holds_back_stream_sender():
+    size = 2 * 1024 * 1024
+    bandwidth = 100 * 1024
+
+    async def main():
+        sim = Simulation(latency=0.001)
+        await sim.start()
+        sender, slow = await sim.join(["sender", "slow"])
+        await sim.settle()
+        sim.slow_down(slow, bandwidth)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        assert await sender.send_stream(io.BytesIO(bytes(size)), "big")
+        # Only what fits in the buffers on the way can be ahead of the slow client
+        assert loop.time() - start > (size - 512 * 1024) / bandwidth
+        await sim.stop()
+
+    run_simulation(main())
+
+
+def run_with_drops(seed):
+    async def main():
+        sim = Simulation(latency=0.001, dropRate=0.002, seed=seed)
+        await sim.start()
+        clients = await sim.join([f"c{i}" for i in range(100)])
+        await sim.settle()
+        for n in range(3):
+            for client in sim.connected():
+                await sim.broadcast(client, str(n))
+        await sim.settle()
+
+        check_views(sim)
+        for client in sim.connected():
+            # Whatever arrives from a sender arrives in order
+            for other in clients:
+                texts = [text for nick, text in client.messages() if nick == other.nick]
+                assert texts == sorted(texts)
+        survivors = len(sim.connected())
+        await sim.stop()
+        return [client.messages() for client in clients], survivors
+
+    return run_simulation(main())
+
+
+def test_drops_are_deterministic():
+    first, survivors = run_with_drops(seed=7)
+    assert 0 < survivors < 100
+    assert run_with_drops(seed=7) == (first, survivors)
+
+
+def test_late_client_knows_every_sender_before_its_messages():
+    async def main():
+        sim = Simulation(latency=0.001)
+        await sim.start()
+        senders = await sim.join([f"sender{i}" for i in range(50)])
+        await sim.settle()
+
+        async def chat(client):
+            for n in range(100):
+                await sim.broadcast(client, str(n))
+                await asyncio.sleep(0.0001)
+
+        chats = [asyncio.create_task(chat(client)) for client in senders]
+        await asyncio.sleep(0.002)
+        late, = await sim.join(["late"])
+        await asyncio.gather(*chats)
+        await sim.settle()
+
+        known = set()
+        for msg in late.received:
+            if msg['option'] == 'join': known.add(msg['nick'])
+            if msg['option'] == 'message': assert msg['nick'] in known
+        assert late.peers() == {sender.nick for sender in senders}
+        await sim.stop()
+
+    run_simulation(main())
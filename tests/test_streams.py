@@ -0,0 +1,216 @@
+import asyncio
+import io
+import pytest
+import common.communication as comms
+from server.server import Server, ClientValues
+from tests.conftest import eventually, start_server, join
+
+
+class Sink(io.BytesIO):
+    """ Sink that keeps what was written to it once closed """
+    def close(self):
+        self.received = self.getvalue()
+        super().close()
+
+
+def sink_for(sinks):
+    def open_sink(msg):
+        sinks[msg['stream']] = Sink()
+        return sinks[msg['stream']]
+    return open_sink
+
+
+@pytest.mark.anyio
+async def test_invalid_stream_ids_are_ignored():
+    server = Server(10)
+    server.clients[1] = ClientValues(None, None, "alice", "127.0.0.1", 1)
+    for stream in ([1], -1, comms.STREAM_ID_LIMIT, "1"):
+        start = {"option": "stream_start", "nick": "alice", "stream": stream, "name": "x"}
+        assert await server.process_client(start, 1) == None
+        end = {"option": "stream_end", "nick": "alice", "stream": stream}
+        assert await server.process_client(end, 1) == None
+    assert server.transfers == {}
+
+
+@pytest.mark.anyio
+async def test_stream_ids_wrap_around_skipping_running_transfers():
+    server = Server(10)
+    server.clients[1] = ClientValues(None, None, "alice", "127.0.0.1", 1)
+    server.lastStream = comms.STREAM_ID_LIMIT - 1
+
+    streams = []
+    for stream in range(3):
+        start = {"option": "stream_start", "nick": "alice", "stream": stream, "name": "x"}
+        streams.append((await server.process_client(start, 1))["stream"])
+    assert streams == [comms.STREAM_ID_LIMIT - 1, 1, 2]
+
+    # Transfer 1 still runs, so the next one skips its Id
+    await server.process_client({"option": "stream_end", "nick": "alice", "stream": 0}, 1)
+    server.lastStream = 1
+    start = {"option": "stream_start", "nick": "alice", "stream": 5, "name": "x"}
+    assert (await server.process_client(start, 1))["stream"] == 3
+
+
+@pytest.mark.anyio
+async def test_malformed_stream_start_keeps_the_client():
+    server, tcp, port = await start_server()
+    alice = await join("alice", port)
+    bob = await join("bob", port)
+    await eventually(lambda: alice.peers() == {"bob"} and bob.peers() == {"alice"})
+
+    writer = alice.connection.writer
+    await comms.send_dict(writer, {"option": "stream_start", "nick": "alice", "stream": [1], "name": "x"})
+    await comms.send_dict(writer, {"option": "message", "message": "still here", "nick": "alice"})
+    await eventually(lambda: bob.messages() == [("alice", "still here")])
+    assert {client.nick for client in server.clients.values()} == {"alice", "bob"}
+
+    for client in (alice, bob):
+        client.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
+
+
+@pytest.mark.anyio
+async def test_receiver_leaving_is_removed_from_transfers():
+    server, tcp, port = await start_server()
+    bobSinks = {}
+    alice = await join("alice", port)
+    bob = await join("bob", port, streamSink=sink_for(bobSinks))
+    carol = await join("carol", port, streamSink=sink_for({}))
+    await eventually(lambda: len(alice.peers()) == 2 and len(bob.peers()) == 2 and len(carol.peers()) == 2)
+
+    writer = alice.connection.writer
+    await comms.send_dict(writer, {"option": "stream_start", "nick": "alice", "stream": 1, "name": "x"})
+    await comms.send_chunk(writer, 1, b'first')
+    await eventually(lambda: len(bobSinks) == 1 and list(bobSinks.values())[0].getvalue() == b'first')
+
+    carol.connection.writer.close()
+    await eventually(lambda: len(server.clients) == 2)
+    transfer, = server.transfers.values()
+    assert len(transfer.recipients) == 1
+
+    await comms.send_chunk(writer, 1, b'second')
+    await comms.send_dict(writer, {"option": "stream_end", "nick": "alice", "stream": 1})
+    await eventually(lambda: bob.incoming == {})
+    assert list(bobSinks.values())[0].received == b'firstsecond'
+
+    for client in (alice, bob):
+        client.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
+
+
+@pytest.mark.anyio
+async def test_stream_reaches_every_receiver_intact():
+    server, tcp, port = await start_server()
+    bobSinks, carolSinks = {}, {}
+    alice = await join("alice", port)
+    bob = await join("bob", port, streamSink=sink_for(bobSinks))
+    carol = await join("carol", port, streamSink=sink_for(carolSinks))
+    await eventually(lambda: len(alice.peers()) == 2 and len(bob.peers()) == 2 and len(carol.peers()) == 2)
+
+    payload = bytes(range(256)) * 4000 + b'tail'
+    alice.lastStream = 1000
+    assert await alice.send_stream(io.BytesIO(payload), "data.bin", chunkSize=10000)
+    await eventually(lambda: len(bobSinks) == len(carolSinks) == 1 and bob.incoming == carol.incoming == {})
+
+    for client, sinks in ((bob, bobSinks), (carol, carolSinks)):
+        (stream, sink), = sinks.items()
+        assert sink.received == payload
+        # Receivers see the Id given by the server, not the sender's
+        assert stream != 1000
+        start, = [msg for msg in client.received if msg['option'] == 'stream_start']
+        assert start['name'] == "data.bin" and start['nick'] == "alice"
+    assert server.transfers == {}
+
+    for client in (alice, bob, carol):
+        client.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
+
+
+@pytest.mark.anyio
+async def test_sender_leaving_aborts_its_streams():
+    server, tcp, port = await start_server()
+    bobSinks = {}
+    alice = await join("alice", port)
+    bob = await join("bob", port, streamSink=sink_for(bobSinks))
+    await eventually(lambda: alice.peers() == {"bob"} and bob.peers() == {"alice"})
+
+    writer = alice.connection.writer
+    await comms.send_dict(writer, {"option": "stream_start", "nick": "alice", "stream": 1, "name": "x"})
+    await comms.send_chunk(writer, 1, b'partial')
+    await eventually(lambda: len(bobSinks) == 1 and list(bobSinks.values())[0].getvalue() == b'partial')
+
+    writer.close()
+    await eventually(lambda: bob.peers() == set())
+    end, = [msg for msg in bob.received if msg['option'] == 'stream_end']
+    assert end['aborted'] and end['stream'] == list(bobSinks.keys())[0]
+    assert bob.incoming == {} and list(bobSinks.values())[0].closed
+    assert server.transfers == {}
+
+    bob.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
+
+
+@pytest.mark.anyio
+async def test_sinks_closed_when_connection_ends():
+    server, tcp, port = await start_server()
+    bobSinks = {}
+    alice = await join("alice", port)
+    bob = await join("bob", port, streamSink=sink_for(bobSinks))
+    await eventually(lambda: alice.peers() == {"bob"} and bob.peers() == {"alice"})
+
+    writer = alice.connection.writer
+    await comms.send_dict(writer, {"option": "stream_start", "nick": "alice", "stream": 1, "name": "x"})
+    await comms.send_chunk(writer, 1, b'partial')
+    await eventually(lambda: len(bobSinks) == 1 and list(bobSinks.values())[0].getvalue() == b'partial')
+
+    bob.connection.writer.close()
+    await bob.task
+    assert bob.incoming == {} and list(bobSinks.values())[0].received == b'partial'
+
+    writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
+
+
+class Zeros:
+    """ Source of zeros that counts how much was read from it """
+    def __init__(self, size):
+        self.size = size
+        self.read_bytes = 0
+
+    def read(self, nBytes):
+        nBytes = min(nBytes, self.size - self.read_bytes)
+        self.read_bytes += nBytes
+        return bytes(nBytes)
+
+
+@pytest.mark.anyio
+async def test_receiver_not_reading_holds_back_the_sender():
+    server, tcp, port = await start_server()
+    alice = await join("alice", port)
+    # A receiver that joins and then never reads
+    _, stuckWriter = await comms.SocketTransport().open_connection('127.0.0.1', port)
+    await comms.send_dict(stuckWriter, {"option": "join", "nick": "stuck", "ip": "127.0.0.1", "port": 0})
+    await eventually(lambda: alice.peers() == {"stuck"})
+
+    source = Zeros(256 * 1024 * 1024)
+    sending = asyncio.create_task(alice.send_stream(source, "zeros"))
+
+    # Wait for the buffers on the way to fill up
+    previous = -1
+    for _ in range(20):
+        if source.read_bytes == previous: break
+        previous = source.read_bytes
+        await asyncio.sleep(0.5)
+    assert not sending.done()
+    assert source.read_bytes < 64 * 1024 * 1024
+
+    sending.cancel()
+    for writer in (alice.connection.writer, stuckWriter):
+        writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close()
@@ -0,0 +1,35 @@
+import pytest
+import common.communication as comms
+from server.server import Server
+from tests.conftest import eventually, join
+
+
+def test_unix_address():
+    assert comms.is_unix_address("unix:/tmp/bridge.sock")
+    assert not comms.is_unix_address("127.0.0.1")
+
+
+@pytest.mark.anyio
+async def test_tcp_and_unix_clients_share_the_registry(tmp_path):
+    server = Server(10)
+    tcp = await server.create_server('127.0.0.1', 0)
+    port = tcp.sockets[0].getsockname()[1]
+    path = comms.UNIX_PREFIX + str(tmp_path / "bridge.sock")
+    uds = await server.create_server(path, 0)
+    await server.create_datagram_endpoint('127.0.0.1', 0)
+
+    alice = await join("alice", port)
+    bob = await join("bob", 0, host=path, datagrams=True)
+    await eventually(lambda: alice.peers() == {"bob"} and bob.peers() == {"alice"})
+
+    await comms.send_dict(alice.connection.writer, {"option": "message", "message": "over tcp", "nick": "alice"})
+    await comms.send_dict(bob.connection.writer, {"option": "message", "message": "over uds", "nick": "bob"})
+    await eventually(lambda: bob.messages() == [("alice", "over tcp")] and alice.messages() == [("bob", "over uds")])
+    # Datagrams need an ip address, the Unix client stays on the stream
+    assert not bob.datagramBound.is_set() and bob.datagram == None
+
+    bob.connection.writer.close()
+    await eventually(lambda: alice.peers() == set())
+    alice.connection.writer.close()
+    await eventually(lambda: server.clients == {})
+    tcp.close(); uds.close(); server.datagram.close()